@@ -0,0 +1,73 @@
+#!/usr/bin/env python3
+
+"""
+Copyright 2018 The Johns Hopkins University Applied Physics Laboratory.
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+# Compare utils.block_plan against file_compute + blockfile_indices.
+#
+#     python3 benchmarks/block_plan.py
+
+import timeit
+
+from bossphorus.storagemanager.utils import (
+    block_plan,
+    blockfile_indices,
+    file_compute,
+)
+
+BLOCK_SIZE = (256, 256, 16)
+
+CASES = {
+    "small, near origin": ((0, 512), (0, 512), (0, 16)),
+    "small, x=200000": ((200000, 200512), (100000, 100512), (5000, 5016)),
+    "small, x=2000000": ((2000000, 2000512), (1000000, 1000512), (50000, 50016)),
+    "large, x=200000": ((200000, 204096), (100000, 104096), (5000, 5128)),
+}
+
+
+def legacy(xs, ys, zs):
+    files = file_compute(xs[0], xs[1], ys[0], ys[1], zs[0], zs[1], BLOCK_SIZE)
+    indices = blockfile_indices(xs, ys, zs, BLOCK_SIZE)
+    return files, indices
+
+
+def planned(xs, ys, zs):
+    return block_plan(xs, ys, zs, BLOCK_SIZE)
+
+
+def planned_iter(xs, ys, zs):
+    return list(block_plan(xs, ys, zs, BLOCK_SIZE).blocks())
+
+
+def main():
+    print(
+        f"{'case':<20} {'blocks':>7} {'legacy ms':>10}"
+        f" {'plan ms':>10} {'plan+iter ms':>13}"
+    )
+    for name, (xs, ys, zs) in CASES.items():
+        blocks = len(block_plan(xs, ys, zs, BLOCK_SIZE))
+        timings = [
+            timeit.timeit(lambda: fn(xs, ys, zs), number=20) / 20 * 1e3
+            for fn in (legacy, planned, planned_iter)
+        ]
+        print(
+            f"{name:<20} {blocks:>7} {timings[0]:>10.3f}"
+            f" {timings[1]:>10.3f} {timings[2]:>13.3f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,157 @@
+#!/usr/bin/env python3
+
+"""
+Copyright 2018 The Johns Hopkins University Applied Physics Laboratory.
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+# Stress ChunkedFilesystemStorageManager (and FilesystemStorageManager, as
+# format "h5") with small overlapping uploads from many processes, each with
+# many threads, as a multi-worker server sees them.
+#
+#     python3 benchmarks/concurrent_writes.py --processes 4 --threads 4
+#
+# Every writer owns its own x columns, and its uploads span block boundaries
+# in y and z, so the writers contend for the same blocks without writing the
+# same voxels. Afterwards, every voxel that a successful upload wrote must
+# still hold that writer's value. Failed uploads and lost voxels are counted
+# per format, and the exit status is 1 if there are any.
+
+import argparse
+import multiprocessing
+import shutil
+import sys
+import threading
+import time
+
+import numpy as np
+
+from bossphorus.storagemanager import (
+    ChunkedFilesystemStorageManager,
+    FilesystemStorageManager,
+)
+
+SHAPE = (128, 128, 32)
+
+
+def _manager(args, fmt):
+    if fmt == "h5":
+        return FilesystemStorageManager(f"{args.path}/{fmt}", tuple(args.block_size))
+    return ChunkedFilesystemStorageManager(
+        f"{args.path}/{fmt}", tuple(args.block_size), preferred_format=fmt
+    )
+
+
+def _write(args, fmt, process):
+    mgr = _manager(args, fmt)
+    writers = args.processes * args.threads
+    written = np.zeros(SHAPE, dtype=bool)
+    failures = []
+
+    def _thread(thread):
+        writer = process * args.threads + thread
+        rng = np.random.default_rng(writer)
+        for i in range(args.uploads):
+            x = writer + (i % (SHAPE[0] // writers)) * writers
+            y = int(rng.integers(0, SHAPE[1] - 8))
+            z = int(rng.integers(0, SHAPE[2] - 4))
+            data = np.full((1, 8, 4), writer + 1, dtype="uint16")
+            try:
+                mgr.setdata(
+                    data,
+                    "bench",
+                    "bench",
+                    "bench",
+                    0,
+                    (x, x + 1),
+                    (y, y + 8),
+                    (z, z + 4),
+                )
+            except Exception as e:  # pylint: disable=broad-except
+                failures.append(repr(e))
+                continue
+            written[x, y : y + 8, z : z + 4] = True
+
+    threads = [threading.Thread(target=_thread, args=(t,)) for t in range(args.threads)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return written, failures
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Stress concurrent uploads from many processes and threads."
+    )
+    parser.add_argument("--path", default="./bench-uploads")
+    parser.add_argument("--block-size", type=int, nargs=3, default=[32, 32, 16])
+    parser.add_argument("--processes", type=int, default=4)
+    parser.add_argument("--threads", type=int, default=4)
+    parser.add_argument("--uploads", type=int, default=100, help="Per thread")
+    parser.add_argument(
+        "--formats", nargs="+", default=["npy", "blosc", "sharded", "h5"]
+    )
+    args = parser.parse_args()
+
+    writers = args.processes * args.threads
+    print(
+        f"{args.processes} processes x {args.threads} threads, "
+        f"{args.uploads} uploads each, block size {tuple(args.block_size)}"
+    )
+    print(f"{'format':>8} {'seconds':>10} {'failed':>8} {'lost':>8}")
+    bad = False
+    shutil.rmtree(args.path, ignore_errors=True)
+    try:
+        for fmt in args.formats:
+            # The channel's datatype is recorded before the writers start:
+            _manager(args, fmt).setdata(
+                np.zeros((1, 1, 1), dtype="uint16"),
+                "bench",
+                "bench",
+                "bench",
+                0,
+                (0, 1),
+                (0, 1),
+                (0, 1),
+            )
+            tic = time.perf_counter()
+            with multiprocessing.get_context("fork").Pool(args.processes) as pool:
+                results = pool.starmap(
+                    _write, [(args, fmt, p) for p in range(args.processes)]
+                )
+            seconds = time.perf_counter() - tic
+
+            written = np.zeros(SHAPE, dtype=bool)
+            failures = []
+            for process_written, process_failures in results:
+                written |= process_written
+                failures += process_failures
+            data = _manager(args, fmt).getdata(
+                "bench", "bench", "bench", 0, *[(0, s) for s in SHAPE]
+            )
+            # Each writer's value, by the x column that it owns:
+            expected = (np.arange(SHAPE[0]) % writers + 1)[:, None, None]
+            lost = int((written & (data != expected)).sum())
+            print(f"{fmt:>8} {seconds:>10.2f} {len(failures):>8} {lost:>8}")
+            for failure in sorted(set(failures)):
+                print(f"{'':>8} {failure}")
+            bad = bad or bool(failures) or bool(lost)
+    finally:
+        shutil.rmtree(args.path, ignore_errors=True)
+    sys.exit(1 if bad else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,89 @@
+#!/usr/bin/env python3
+
+"""
+Copyright 2018 The Johns Hopkins University Applied Physics Laboratory.
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+# Measure ChunkedFilesystemStorageManager.getdata throughput by worker count.
+#
+# Run it once per filesystem you care about, for example:
+#
+#     python3 benchmarks/getdata_workers.py --path /mnt/nvme/bench
+#     python3 benchmarks/getdata_workers.py --path /mnt/nfs/bench
+#
+# When run as root with --drop-caches, the page cache is dropped before every
+# read so that the numbers reflect the disk rather than RAM.
+
+import argparse
+import shutil
+import subprocess
+import time
+
+import numpy as np
+
+from bossphorus.storagemanager import ChunkedFilesystemStorageManager
+
+
+def drop_caches():
+    subprocess.run(["sync"], check=True)
+    with open("/proc/sys/vm/drop_caches", "w") as fh:
+        fh.write("3\n")
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Time ChunkedFilesystemStorageManager.getdata by worker count."
+    )
+    parser.add_argument("--path", default="./bench-uploads")
+    parser.add_argument("--block-size", type=int, nargs=3, default=[256, 256, 256])
+    parser.add_argument("--shape", type=int, nargs=3, default=[1024, 1024, 512])
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4, 8, 16])
+    parser.add_argument("--repeats", type=int, default=3)
+    parser.add_argument("--drop-caches", action="store_true")
+    parser.add_argument("--keep", action="store_true", help="Don't delete --path")
+    args = parser.parse_args()
+
+    block_size = tuple(args.block_size)
+    xs, ys, zs = [(0, s) for s in args.shape]
+    nbytes = int(np.prod(args.shape))
+
+    writer = ChunkedFilesystemStorageManager(args.path, block_size)
+    data = np.random.randint(0, 255, args.shape, dtype="uint8")
+    writer.setdata(data, "bench", "bench", "bench", 0, xs, ys, zs)
+    del data
+
+    print(f"{nbytes / 2**20:.0f} MiB cutout, block size {block_size}, {args.path}")
+    print(f"{'workers':>8} {'seconds':>10} {'MiB/s':>10}")
+    try:
+        for workers in args.workers:
+            mgr = ChunkedFilesystemStorageManager(
+                args.path, block_size, workers=workers
+            )
+            timings = []
+            for _ in range(args.repeats):
+                if args.drop_caches:
+                    drop_caches()
+                tic = time.perf_counter()
+                mgr.getdata("bench", "bench", "bench", 0, xs, ys, zs)
+                timings.append(time.perf_counter() - tic)
+            best = min(timings)
+            print(f"{workers:>8} {best:>10.3f} {nbytes / 2**20 / best:>10.1f}")
+    finally:
+        if not args.keep:
+            shutil.rmtree(args.path, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
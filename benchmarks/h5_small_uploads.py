@@ -0,0 +1,101 @@
+#!/usr/bin/env python3
+
+"""
+Copyright 2018 The Johns Hopkins University Applied Physics Laboratory.
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+# Measure small uploads into a large .h5 with FilesystemStorageManager.
+#
+# A volume of --shape is written first, a z-slab at a time, and then many
+# small cuboids are uploaded at random places inside it, and then just past
+# its far x edge, so that the file has to grow.
+#
+#     python3 benchmarks/h5_small_uploads.py --path /mnt/nvme/bench
+
+import argparse
+import os
+import shutil
+import time
+
+import numpy as np
+
+from bossphorus.storagemanager import FilesystemStorageManager
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Time small uploads into a large HDF5 volume."
+    )
+    parser.add_argument("--path", default="./bench-uploads")
+    parser.add_argument("--shape", type=int, nargs=3, default=[2048, 2048, 512])
+    parser.add_argument("--upload", type=int, nargs=3, default=[64, 64, 16])
+    parser.add_argument("--count", type=int, default=200)
+    args = parser.parse_args()
+
+    shutil.rmtree(args.path, ignore_errors=True)
+    mgr = FilesystemStorageManager(args.path, (128, 128, 128))
+    X, Y, Z = args.shape
+    try:
+        slab = np.random.randint(0, 255, (X, Y, 16), dtype="uint8")
+        tic = time.perf_counter()
+        for z in range(0, Z, 16):
+            depth = min(16, Z - z)
+            mgr.setdata(
+                slab[:, :, :depth],
+                "bench",
+                "bench",
+                "bench",
+                0,
+                (0, X),
+                (0, Y),
+                (z, z + depth),
+            )
+        elapsed = time.perf_counter() - tic
+        fname = f"{args.path}/bench/bench/bench/0.h5"
+        print(
+            f"{X * Y * Z / 2**30:.2f} GiB volume written in {elapsed:.1f} s"
+            f" ({os.path.getsize(fname) / 2**30:.2f} GiB on disk)"
+        )
+
+        rng = np.random.default_rng(0)
+        u = args.upload
+        upload = np.random.randint(0, 255, u, dtype="uint8")
+        for name, x_range in [("inside", (0, X - u[0])), ("growing", (X, 2 * X))]:
+            tic = time.perf_counter()
+            for _ in range(args.count):
+                x = int(rng.integers(*x_range))
+                y = int(rng.integers(0, Y - u[1]))
+                z = int(rng.integers(0, Z - u[2]))
+                mgr.setdata(
+                    upload,
+                    "bench",
+                    "bench",
+                    "bench",
+                    0,
+                    (x, x + u[0]),
+                    (y, y + u[1]),
+                    (z, z + u[2]),
+                )
+            elapsed = time.perf_counter() - tic
+            print(
+                f"{args.count} {tuple(u)} uploads {name:<8}"
+                f" {elapsed / args.count * 1000:8.2f} ms each"
+            )
+    finally:
+        shutil.rmtree(args.path, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,77 @@
+#!/usr/bin/env python3
+
+"""
+Copyright 2018 The Johns Hopkins University Applied Physics Laboratory.
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+# Measure ChunkedFilesystemStorageManager.setdata throughput for bulk ingest.
+#
+# A block-aligned upload covers every block it touches, so each block is
+# written without being read first. Trimming one voxel from each face of
+# the same upload leaves it touching the same blocks, but only partially,
+# which forces a read-modify-write of each one.
+# Both are run into an empty store and into a store that already holds
+# data, which is where the read-modify-write costs the most.
+#
+#     python3 benchmarks/ingest.py --path /mnt/nvme/bench
+
+import argparse
+import shutil
+import time
+
+import numpy as np
+
+from bossphorus.storagemanager import ChunkedFilesystemStorageManager
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Time aligned and unaligned bulk uploads."
+    )
+    parser.add_argument("--path", default="./bench-uploads")
+    parser.add_argument("--block-size", type=int, nargs=3, default=[256, 256, 256])
+    parser.add_argument("--shape", type=int, nargs=3, default=[1024, 1024, 256])
+    parser.add_argument("--format", default="npy")
+    args = parser.parse_args()
+
+    block_size = tuple(args.block_size)
+    # Uploads arrive in ZYX order and are handed to setdata as an XYZ view:
+    data = np.random.randint(0, 255, args.shape[::-1], dtype="uint8").transpose()
+    nbytes = data.nbytes
+
+    print(f"{nbytes / 2**20:.0f} MiB upload, block size {block_size}, {args.path}")
+    print(f"{'upload':<10} {'store':<10} {'seconds':>10} {'MiB/s':>10}")
+    try:
+        for name, trim in [("aligned", 0), ("unaligned", 1)]:
+            shutil.rmtree(args.path, ignore_errors=True)
+            mgr = ChunkedFilesystemStorageManager(
+                args.path, block_size, preferred_format=args.format
+            )
+            xs, ys, zs = [(trim, s - trim) for s in args.shape]
+            upload = data[xs[0] : xs[1], ys[0] : ys[1], zs[0] : zs[1]]
+            for state in ["empty", "populated"]:
+                tic = time.perf_counter()
+                mgr.setdata(upload, "bench", "bench", "bench", 0, xs, ys, zs)
+                elapsed = time.perf_counter() - tic
+                print(
+                    f"{name:<10} {state:<10} {elapsed:>10.3f}"
+                    f" {nbytes / 2**20 / elapsed:>10.1f}"
+                )
+    finally:
+        shutil.rmtree(args.path, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -21,6 +21,7 @@ import json
 import datetime
 import os
 import sys
+import zlib
 from typing import List
 
 import blosc
@@ -28,6 +29,7 @@ from flask import Flask, request, Response, jsonify, make_response, render_templ
 import numpy as np
 
 from . import storagemanager
+from . import tiles
 from .storagemanager import (
     FilesystemStorageManager,
     RelayStorageManager,
@@ -37,13 +39,117 @@ from . import version
 
 __version__ = version.__version__
 
+# The z-depth of each slab in a streamed cutout, when the storage manager
+# doesn't have a (positive) block size of its own:
+DEFAULT_SLAB_DEPTH = 16
+
+
+def infer_dtype(nbytes: int, voxels: int) -> str:
+    """
+    Guess the datatype of an upload from its size and the size of its cutout.
+
+    Volumetric data are unsigned integers, so 2 bytes per voxel is "uint16".
+    The item size in the blosc header can't be used, because clients such as
+    intern put the bit width there rather than the byte width.
+
+    Raises:
+        ValueError: If the data aren't a whole number of bytes per voxel
+
+    """
+    if voxels <= 0 or nbytes % voxels:
+        raise ValueError("Got {} bytes of data for {} voxels.".format(nbytes, voxels))
+    dtype = "uint{}".format(8 * (nbytes // voxels))
+    if dtype not in ("uint8", "uint16", "uint32", "uint64"):
+        raise ValueError("Unsupported item size of {} bytes.".format(nbytes // voxels))
+    return dtype
+
+
+def stream_cutout(
+    manager: storagemanager.StorageManager,
+    collection: str,
+    experiment: str,
+    channel: str,
+    resolution: int,
+    xs: List[int],
+    ys: List[int],
+    zs: List[int],
+    compress: bool = False,
+):
+    """
+    Read a cutout one z-slab at a time, and yield it as bytes in ZYX order.
+
+    Each slab is one z block row deep, so peak memory is bounded by a single
+    slab rather than by the whole volume. The first slab is read before this
+    function returns, so that a missing volume raises here rather than
+    partway through a response.
+
+    Arguments:
+        manager: The storage manager to read from
+        bossURI
+        compress (bool: False): If True, yield a zlib-compressed .npy file
+            (the bossDB `application/npygz` format). Otherwise yield raw bytes.
+
+    Returns:
+        Iterator[bytes]
 
-def create_app(mgr: storagemanager.StorageManager = None):
+    """
+    depth = (getattr(manager, "block_size", None) or (0, 0, 0))[2]
+    if depth <= 0:
+        depth = DEFAULT_SLAB_DEPTH
+    # Slabs follow the block grid, so that no block is read twice:
+    bounds = list(range((zs[0] // depth + 1) * depth, zs[1], depth))
+    slabs = list(zip([zs[0], *bounds], [*bounds, zs[1]]))
+
+    def _read_slab(z_range):
+        data = manager.getdata(
+            collection, experiment, channel, resolution, xs, ys, list(z_range)
+        )
+        return np.ascontiguousarray(np.transpose(data))
+
+    def _generate(first):
+        # `first` is dropped once it has been sent, so that only one slab is
+        # held at a time.
+        if compress:
+            gz = zlib.compressobj()
+            header = io.BytesIO()
+            np.lib.format.write_array_header_1_0(
+                header,
+                {
+                    "descr": np.lib.format.dtype_to_descr(first.dtype),
+                    "fortran_order": False,
+                    "shape": (zs[1] - zs[0], ys[1] - ys[0], xs[1] - xs[0]),
+                },
+            )
+            yield gz.compress(header.getvalue())
+            chunk, first = gz.compress(first.data), None
+            yield chunk
+            for z_range in slabs[1:]:
+                yield gz.compress(_read_slab(z_range).data)
+            yield gz.flush()
+        else:
+            chunk, first = first.tobytes(), None
+            yield chunk
+            for z_range in slabs[1:]:
+                yield _read_slab(z_range).tobytes()
+
+    return _generate(_read_slab(slabs[0]))
+
+
+def create_app(
+    mgr: storagemanager.StorageManager = None, tile_cache: tiles.TileCache = None
+):
     """
     Create a Bossphorus server app.
+
+    Arguments:
+        mgr (StorageManager): Where to store data. By default, a
+            ChunkedFilesystemStorageManager in ./uploads, relaying to bossDB
+        tile_cache (TileCache): Where to cache rendered tiles. By default, a
+            TileCache of 256 MiB
     """
     app = Flask(__name__)
     created = datetime.datetime.now()
+    tile_cache = tile_cache if tile_cache is not None else tiles.TileCache()
     if mgr:
         manager = mgr
     else:
@@ -70,13 +176,38 @@ def create_app(mgr: storagemanager.StorageManager = None):
 
         Uses bossURI format.
         """
-        data = np.fromstring(blosc.decompress(request.data), dtype="uint8")
         xs = [int(i) for i in x_range.split(":")]
         ys = [int(i) for i in y_range.split(":")]
         zs = [int(i) for i in z_range.split(":")]
-        data = data.reshape(xs[1] - xs[0], ys[1] - ys[0], zs[1] - zs[0])
-        data = data.transpose()
-        manager.setdata(data, collection, experiment, channel, resolution, zs, ys, xs)
+        compressed = request.get_data(cache=False)
+        shape = (zs[1] - zs[0], ys[1] - ys[0], xs[1] - xs[0])
+        nbytes, _, _ = blosc.get_cbuffer_sizes(compressed)
+        # The channel's datatype wins if it is known. Otherwise, it follows
+        # from the size of the data:
+        dtype = manager.get_dtype(collection, experiment, channel)
+        try:
+            if dtype is None:
+                dtype = infer_dtype(nbytes, int(np.prod(shape)))
+            # Decompress straight into the final buffer. The body is in ZYX
+            # order, so the transpose below is an XYZ view of the same memory,
+            # which setdata scatters directly into blocks without another copy.
+            data = np.empty(shape, dtype=dtype)
+            if nbytes != data.nbytes:
+                raise ValueError(
+                    "Expected {} bytes of data, got {}.".format(data.nbytes, nbytes)
+                )
+        except ValueError as e:
+            return Response(
+                json.dumps({"message": str(e)}),
+                status=400,
+                mimetype="application/json",
+            )
+        blosc.decompress_ptr(compressed, data.__array_interface__["data"][0])
+        del compressed
+        manager.setdata(
+            data.transpose(), collection, experiment, channel, resolution, xs, ys, zs
+        )
+        tile_cache.invalidate(collection, experiment, channel, resolution, xs, ys, zs)
         return make_response("", 201)
 
     @app.route(
@@ -90,14 +221,33 @@ def create_app(mgr: storagemanager.StorageManager = None):
         for _, f in request.files.items():
             memfile = io.BytesIO()
             f.save(memfile)
-            data = np.fromstring(memfile.getvalue(), dtype="uint8")
             xs = [int(i) for i in x_range.split(":")]
             ys = [int(i) for i in y_range.split(":")]
             zs = [int(i) for i in z_range.split(":")]
-            data = data.reshape(xs[1] - xs[0], ys[1] - ys[0], zs[1] - zs[0])
+            shape = (xs[1] - xs[0], ys[1] - ys[0], zs[1] - zs[0])
+            nbytes = memfile.getbuffer().nbytes
+            dtype = manager.get_dtype(collection, experiment, channel)
+            try:
+                if dtype is None:
+                    dtype = infer_dtype(nbytes, int(np.prod(shape)))
+                expected = int(np.prod(shape)) * np.dtype(dtype).itemsize
+                if nbytes != expected:
+                    raise ValueError(
+                        "Expected {} bytes of data, got {}.".format(expected, nbytes)
+                    )
+            except ValueError as e:
+                return Response(
+                    json.dumps({"message": str(e)}),
+                    status=400,
+                    mimetype="application/json",
+                )
+            data = np.frombuffer(memfile.getbuffer(), dtype=dtype).reshape(shape)
             manager.setdata(
                 data, collection, experiment, channel, resolution, xs, ys, zs
             )
+            tile_cache.invalidate(
+                collection, experiment, channel, resolution, xs, ys, zs
+            )
         return ""
 
     @app.route(
@@ -108,6 +258,7 @@ def create_app(mgr: storagemanager.StorageManager = None):
         """
         Uses bossURI format.
         """
+        datatype = manager.get_dtype(collection, experiment, channel) or "uint8"
         return jsonify(
             {
                 "name": channel,
@@ -115,12 +266,14 @@ def create_app(mgr: storagemanager.StorageManager = None):
                 "experiment": experiment,
                 "collection": collection,
                 "default_time_sample": 0,
-                "type": "image",
+                "type": "annotation" if datatype == "uint64" else "image",
                 "base_resolution": 0,
-                "datatype": "uint8",
+                "datatype": datatype,
                 "creator": "None",
                 "sources": [],
-                "downsample_status": "NOT_DOWNSAMPLED",
+                "downsample_status": manager.get_downsample_status(
+                    collection, experiment, channel
+                ),
                 "related": [],
             }
         )
@@ -166,23 +319,188 @@ def create_app(mgr: storagemanager.StorageManager = None):
         """
         Download a volume.
 
+        Returns a blosc-compressed buffer by default. Requests that accept
+        `application/npygz` or `application/octet-stream` get a response that
+        is streamed slab by slab instead.
+
         Returns 404 if the bossURI is not found.
         """
         xs = [int(i) for i in x_range.split(":")]
         ys = [int(i) for i in y_range.split(":")]
         zs = [int(i) for i in z_range.split(":")]
+        accept = request.accept_mimetypes
         try:
+            # Streamed formats are assembled one slab at a time, so that very
+            # large cutouts don't have to fit in memory all at once:
+            for mimetype, compress in [
+                ("application/npygz", True),
+                ("application/octet-stream", False),
+            ]:
+                if accept.best == mimetype:
+                    return Response(
+                        stream_cutout(
+                            manager,
+                            collection,
+                            experiment,
+                            channel,
+                            resolution,
+                            xs,
+                            ys,
+                            zs,
+                            compress=compress,
+                        ),
+                        mimetype=mimetype,
+                    )
             data = manager.getdata(
                 collection, experiment, channel, resolution, xs, ys, zs
             )
             data = np.ascontiguousarray(np.transpose(data))
-            response = make_response(blosc.compress(data, typesize=16))
+            response = make_response(blosc.compress(data, typesize=data.dtype.itemsize))
             return response
-        except IOError as e:
+        except (IOError, IndexError) as e:
             return Response(
                 json.dumps({"message": str(e)}), status=404, mimetype="application/json"
             )
 
+    def _image_format():
+        best = request.accept_mimetypes.best_match(
+            list(tiles.MIMETYPES.values()), default="image/png"
+        )
+        return "jpeg" if best == "image/jpeg" else "png"
+
+    def _image_error(message: str, status: int = 400):
+        return Response(
+            json.dumps({"message": message}),
+            status=status,
+            mimetype="application/json",
+        )
+
+    def _render(collection, experiment, channel, resolution, orientation, bounds, fmt):
+        """
+        Read one plane and encode it as an image.
+
+        Only the blocks that the plane passes through are read.
+        """
+        data = manager.getdata(collection, experiment, channel, resolution, *bounds)
+        return tiles.encode_image(tiles.to_plane(data, orientation), fmt)
+
+    @app.route(
+        "/v1/image/<collection>/<experiment>/<channel>/<orientation>/"
+        "<resolution>/<x_arg>/<y_arg>/<z_arg>/",
+        methods=["GET"],
+    )
+    @app.route(
+        "/v1/image/<collection>/<experiment>/<channel>/<orientation>/"
+        "<resolution>/<x_arg>/<y_arg>/<z_arg>/<int:t_index>/",
+        methods=["GET"],
+    )
+    def get_image(
+        collection,
+        experiment,
+        channel,
+        orientation,
+        resolution,
+        x_arg,
+        y_arg,
+        z_arg,
+        t_index=0,
+    ):
+        """
+        Download one plane of a volume as a PNG or JPEG image.
+
+        The two axes of `orientation` are "start:stop" ranges, and the third
+        is the index of the plane. Only 3D data (`t_index` 0) are supported.
+        """
+        try:
+            if t_index != 0:
+                raise ValueError("Only time index 0 is supported.")
+            bounds = tiles.plane_bounds(orientation, [x_arg, y_arg, z_arg])
+            fmt = _image_format()
+            image = _render(
+                collection, experiment, channel, resolution, orientation, bounds, fmt
+            )
+        except ValueError as e:
+            return _image_error(str(e))
+        except RuntimeError as e:
+            return _image_error(str(e), 406)
+        except (IOError, IndexError) as e:
+            return _image_error(str(e), 404)
+        return Response(image, mimetype=tiles.MIMETYPES[fmt])
+
+    @app.route(
+        "/v1/tile/<collection>/<experiment>/<channel>/<orientation>/"
+        "<int:tile_size>/<resolution>/<int:x_idx>/<int:y_idx>/<int:z_idx>/",
+        methods=["GET"],
+    )
+    @app.route(
+        "/v1/tile/<collection>/<experiment>/<channel>/<orientation>/"
+        "<int:tile_size>/<resolution>/<int:x_idx>/<int:y_idx>/<int:z_idx>/"
+        "<int:t_idx>/",
+        methods=["GET"],
+    )
+    def get_tile(
+        collection,
+        experiment,
+        channel,
+        orientation,
+        tile_size,
+        resolution,
+        x_idx,
+        y_idx,
+        z_idx,
+        t_idx=0,
+    ):
+        """
+        Download a square tile of one plane as a PNG or JPEG image.
+
+        The two axes of `orientation` are indexed in units of `tile_size`,
+        and the third is the index of the plane. Tiles are cached until a
+        write to the blocks beneath them.
+        """
+        try:
+            if t_idx != 0:
+                raise ValueError("Only time index 0 is supported.")
+            bounds = tiles.tile_bounds(orientation, tile_size, [x_idx, y_idx, z_idx])
+            fmt = _image_format()
+            key = (
+                collection,
+                experiment,
+                channel,
+                int(resolution),
+                orientation,
+                tile_size,
+                x_idx,
+                y_idx,
+                z_idx,
+                fmt,
+            )
+            image = tile_cache.get(key)
+            if image is None:
+                generation = tile_cache.generation(collection, experiment, channel)
+                # Lower resolutions that are still being built would be
+                # cached out of date:
+                building = int(resolution) > 0 and manager.get_downsample_status(
+                    collection, experiment, channel
+                ) in ("QUEUED", "IN_PROGRESS")
+                image = _render(
+                    collection,
+                    experiment,
+                    channel,
+                    resolution,
+                    orientation,
+                    bounds,
+                    fmt,
+                )
+                if not building:
+                    tile_cache.put(key, bounds, image, generation)
+        except ValueError as e:
+            return _image_error(str(e))
+        except RuntimeError as e:
+            return _image_error(str(e), 406)
+        except (IOError, IndexError) as e:
+            return _image_error(str(e), 404)
+        return Response(image, mimetype=tiles.MIMETYPES[fmt])
+
     @app.route("/")
     def home():
         return render_template(
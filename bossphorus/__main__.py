@@ -14,10 +14,123 @@ See the License for the specific language governing permissions and
 limitations under the License.
 """
 
+import argparse
+import sys
+
 import bossphorus
 
 
-def main():
+def _parse_args(argv=None):
+    parser = argparse.ArgumentParser(
+        prog="bossphorus", description="Run a Bossphorus server."
+    )
+    parser.add_argument("--host", default="0.0.0.0", help="Address to bind to")
+    parser.add_argument("--port", type=int, default=5000, help="Port to bind to")
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="Number of worker processes (default: 1). Each process caches on "
+        "its own, so see the README before running more than one",
+    )
+    parser.add_argument(
+        "--threads", type=int, default=4, help="Request threads per worker process"
+    )
+    parser.add_argument(
+        "--keepalive",
+        type=int,
+        default=5,
+        help="Seconds to hold an idle keep-alive connection open",
+    )
+    parser.add_argument(
+        "--max-request-size",
+        type=int,
+        default=None,
+        help="Largest request body to accept, in bytes (default: unlimited)",
+    )
+    parser.add_argument(
+        "--timeout",
+        type=int,
+        default=300,
+        help="Seconds a request may run before its worker is restarted",
+    )
+    parser.add_argument(
+        "--graceful-timeout",
+        type=int,
+        default=60,
+        help="Seconds to let in-flight requests finish on shutdown",
+    )
+    parser.add_argument(
+        "--tile-cache-ttl",
+        type=float,
+        default=None,
+        help="Seconds to cache rendered tiles for (default: forever with one "
+        "worker process; with more, tiles aren't cached, since each worker's "
+        "cache misses uploads to the others)",
+    )
+    parser.add_argument(
+        "--dev",
+        action="store_true",
+        help="Use Flask's single-process development server instead",
+    )
+    return parser.parse_args(argv)
+
+
+def _create_app(args):
+    tile_cache = None
+    if args.tile_cache_ttl is not None:
+        tile_cache = bossphorus.tiles.TileCache(ttl=args.tile_cache_ttl)
+    elif args.workers > 1 and not args.dev:
+        tile_cache = bossphorus.tiles.TileCache(max_bytes=0)
+    app = bossphorus.create_app(tile_cache=tile_cache)
+    app.config["MAX_CONTENT_LENGTH"] = args.max_request_size
+    return app
+
+
+def _run_gunicorn(args):
+    from gunicorn.app.base import BaseApplication
+
+    class BossphorusApplication(BaseApplication):
+        """
+        Serve Bossphorus with gunicorn.
+
+        The app (and so its storage managers, with their thread pools and
+        open files) is created separately in every worker process after it
+        has forked, rather than once in the parent.
+        """
+
+        def load_config(self):
+            self.cfg.set("bind", f"{args.host}:{args.port}")
+            self.cfg.set("workers", args.workers)
+            self.cfg.set("threads", args.threads)
+            self.cfg.set("worker_class", "gthread")
+            self.cfg.set("keepalive", args.keepalive)
+            self.cfg.set("timeout", args.timeout)
+            self.cfg.set("graceful_timeout", args.graceful_timeout)
+            self.cfg.set("preload_app", False)
+
+        def load(self):
+            return _create_app(args)
+
+    BossphorusApplication().run()
+
+
+def main(argv=None):
     """Entry point for Bossphorus."""
-    app = bossphorus.create_app()
-    app.run(host="0.0.0.0", port=5000)
+    args = _parse_args(argv)
+    if args.dev:
+        _create_app(args).run(host=args.host, port=args.port, threaded=True)
+        return
+    try:
+        import gunicorn  # pylint: disable=unused-import
+    except ImportError:
+        sys.exit(
+            "The production server needs gunicorn. Install it with "
+            "`pip install bossphorus[server]`, or pass --dev to use the "
+            "development server."
+        )
+    _run_gunicorn(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -15,7 +15,7 @@ limitations under the License.
 """
 
 from abc import ABC, abstractmethod
-from typing import Tuple
+from typing import List, Optional, Tuple
 
 import numpy as np
 
@@ -72,3 +72,88 @@ class StorageManager(ABC):
     @abstractmethod
     def get_stack_names(self):
         ...
+
+    def get_dtype(self, col: str, exp: str, chan: str) -> Optional[str]:
+        """
+        Get the datatype of a channel, if this manager knows it.
+
+        Arguments:
+            col, exp, chan
+
+        Returns:
+            str: The numpy name of the datatype (e.g. "uint16"), or None
+
+        """
+        return None
+
+    def get_downsample_status(self, col: str, exp: str, chan: str) -> str:
+        """
+        Get the bossDB downsample status of a channel.
+
+        Arguments:
+            col, exp, chan
+
+        Returns:
+            str: One of "NOT_DOWNSAMPLED", "QUEUED", "IN_PROGRESS" or
+                "DOWNSAMPLED"
+
+        """
+        return "NOT_DOWNSAMPLED"
+
+    def get_extent(
+        self, col: str, exp: str, chan: str, res: int
+    ) -> Optional[List[Tuple[int, int]]]:
+        """
+        Get the bounds of a channel's dataset, if this manager knows them.
+
+        Reads outside of the extent may be refused with an IndexError.
+
+        Arguments:
+            col, exp, chan, res
+
+        Returns:
+            List[Tuple[int, int]]: The (start, stop) bounds of x, y and z at
+                resolution `res`, or None
+
+        """
+        return None
+
+    def setdata_masked(
+        self,
+        data: np.array,
+        mask: np.array,
+        col: str,
+        exp: str,
+        chan: str,
+        res: int,
+        xs: Tuple[int, int],
+        ys: Tuple[int, int],
+        zs: Tuple[int, int],
+    ):
+        """
+        Upload only the voxels of the data where `mask` is True.
+
+        The rest of the region keeps what is already stored. By default the
+        region is read, merged and written back, which isn't atomic: a write
+        that lands in between is lost. Managers that can lock the region
+        across the read-modify-write should override this.
+
+        Arguments:
+            data: The data to write
+            mask: A boolean array of the same shape as `data`
+            bossURI
+
+        """
+        if mask.all():
+            self.setdata(data, col, exp, chan, res, xs, ys, zs)
+            return
+        try:
+            merged = self.getdata(col, exp, chan, res, xs, ys, zs)
+        except (IOError, IndexError):
+            merged = None
+        if merged is None or merged.shape != mask.shape:
+            merged = np.zeros(mask.shape, dtype=data.dtype)
+        elif merged.dtype != data.dtype or not merged.flags.writeable:
+            merged = merged.astype(data.dtype)
+        np.copyto(merged, data, where=mask)
+        self.setdata(merged, col, exp, chan, res, xs, ys, zs)
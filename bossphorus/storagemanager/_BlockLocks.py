@@ -0,0 +1,172 @@
+"""
+Copyright 2018 The Johns Hopkins University Applied Physics Laboratory.
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+from contextlib import contextmanager
+import os
+import struct
+import threading
+import zlib
+
+try:
+    import fcntl
+except ImportError:  # pragma: no cover
+    # Not a POSIX system; locks only coordinate threads in this process.
+    fcntl = None
+
+# struct flock: l_type, l_whence, l_start, l_len, l_pid (and padding).
+_FLOCK = struct.Struct("hhqqi4x")
+
+# Whether locks belong to a descriptor, rather than to the whole process:
+OFD_LOCKS = fcntl is not None and hasattr(fcntl, "F_OFD_SETLKW")
+
+
+def lock_range(fd: int, exclusive: bool, start: int = 0, length: int = 0):
+    """
+    Take a lock on a range of bytes of an open file, waiting for it.
+
+    Where they are available (Linux), open file description locks are used.
+    They belong to the descriptor that took them, rather than to the whole
+    process, so threads that each open the file are kept apart, and the
+    kernel never reports a false deadlock between processes that take
+    several locks from many threads. Elsewhere, POSIX record locks are used,
+    which belong to the process.
+
+    Arguments:
+        fd: The open file
+        exclusive (bool): Whether to take an exclusive (or shared) lock
+        start (int: 0): The first byte to lock
+        length (int: 0): How many bytes to lock. 0 locks to the end of file.
+
+    """
+    if fcntl is None:
+        return
+    if OFD_LOCKS:
+        kind = fcntl.F_WRLCK if exclusive else fcntl.F_RDLCK
+        fcntl.fcntl(
+            fd, fcntl.F_OFD_SETLKW, _FLOCK.pack(kind, os.SEEK_SET, start, length, 0)
+        )
+    else:  # pragma: no cover
+        fcntl.lockf(fd, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH, length, start)
+
+
+def unlock_range(fd: int, start: int = 0, length: int = 0):
+    """
+    Drop a lock taken with `lock_range`.
+    """
+    if fcntl is None:
+        return
+    if OFD_LOCKS:
+        fcntl.fcntl(
+            fd,
+            fcntl.F_OFD_SETLK,
+            _FLOCK.pack(fcntl.F_UNLCK, os.SEEK_SET, start, length, 0),
+        )
+    else:  # pragma: no cover
+        fcntl.lockf(fd, fcntl.LOCK_UN, length, start)
+
+
+class BlockLocks:
+    """
+    Exclusive locks on blocks, shared by threads and by processes.
+
+    Each channel directory has one lock file. A block maps to one of
+    `stripes` bytes of that file, and holding the block's lock means holding
+    a lock on that byte (see `lock_range`), through a descriptor of the lock
+    file that is opened for the purpose. A thread lock per stripe is taken
+    first, so that threads in the same process queue up without holding
+    descriptors.
+
+    Where only POSIX record locks are available, which belong to the whole
+    process, one descriptor per lock file is held open for the life of the
+    process instead, because closing any descriptor of a file drops every
+    record lock the process holds on it.
+
+    Two blocks can share a stripe, which only costs some concurrency.
+    """
+
+    def __init__(
+        self, storage_path: str, lock_name: str = ".locks", stripes: int = 1024
+    ) -> None:
+        """
+        Create a new BlockLocks.
+
+        Arguments:
+            storage_path: The root of the data tree
+            lock_name (str: ".locks"): Name of the lock file in each channel
+                directory. Use a different name for each independent set of
+                locks.
+            stripes (int: 1024): Number of locks per channel
+        """
+        self.storage_path = storage_path
+        self.lock_name = lock_name
+        self.stripes = stripes
+        self._channels = set()
+        self._fds = {}
+        self._thread_locks = {}
+        self._lock = threading.Lock()
+
+    def _open(self, col: str, exp: str, chan: str) -> int:
+        """
+        Open the lock file of a channel. Without OFD_LOCKS, the descriptor is
+        shared, and must not be closed.
+        """
+        channel_path = "{}/{}/{}/{}".format(self.storage_path, col, exp, chan)
+        fname = "{}/{}".format(channel_path, self.lock_name)
+        if channel_path not in self._channels:
+            os.makedirs(channel_path, exist_ok=True)
+            with self._lock:
+                self._channels.add(channel_path)
+        if OFD_LOCKS:
+            return os.open(fname, os.O_RDWR | os.O_CREAT, 0o644)
+        with self._lock:  # pragma: no cover
+            if fname not in self._fds:
+                self._fds[fname] = os.open(fname, os.O_RDWR | os.O_CREAT, 0o644)
+            return self._fds[fname]
+
+    def _thread_lock(self, key) -> threading.Lock:
+        with self._lock:
+            if key not in self._thread_locks:
+                self._thread_locks[key] = threading.Lock()
+            return self._thread_locks[key]
+
+    @contextmanager
+    def lock(self, col: str, exp: str, chan: str, *key):
+        """
+        Hold the lock for a block (or any other key) within a channel.
+
+        Arguments:
+            col, exp, chan
+            key: The rest of the key, e.g. resolution and block origin
+
+        """
+        # crc32 rather than hash(), which is salted differently per process.
+        # Keys are compared as strings, so that res=0 and res="0" match, just
+        # as they name the same file:
+        stripe = zlib.crc32("/".join(str(k) for k in key).encode()) % self.stripes
+        thread_lock = self._thread_lock((col, exp, chan, stripe))
+        with thread_lock:
+            if fcntl is None:
+                yield
+                return
+            fd = self._open(col, exp, chan)
+            try:
+                lock_range(fd, True, stripe, 1)
+                try:
+                    yield
+                finally:
+                    unlock_range(fd, stripe, 1)
+            finally:
+                if OFD_LOCKS:
+                    os.close(fd)
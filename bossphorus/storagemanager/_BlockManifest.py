@@ -0,0 +1,168 @@
+"""
+Copyright 2018 The Johns Hopkins University Applied Physics Laboratory.
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+from typing import Callable, Dict, Iterable, Optional, Set, Tuple, Union
+import os
+import threading
+
+Value = Union[int, float]
+
+
+class BlockManifest:
+    """
+    The set of blocks that are present for one channel and resolution.
+
+    The manifest is an append-only text file with one "x,y,z" block origin
+    per line. A block whose voxels all hold the same value is recorded as
+    "x,y,z=value" instead, and has no block file. When a block appears more
+    than once, the last line wins.
+
+    The file is read once, and after that only the lines that other writers
+    (threads or processes) have appended since are read, when a lookup
+    misses or on `refresh`. Appending a single short line is atomic, so no
+    locking is needed between processes.
+    """
+
+    def __init__(
+        self, fname: str, scan: Callable[[], Iterable[Tuple[int, int, int]]] = None
+    ) -> None:
+        """
+        Create a new BlockManifest.
+
+        Arguments:
+            fname: The path of the manifest file
+            scan: A function that lists the blocks already on disk. It is
+                used to build the manifest for data that were written before
+                manifests existed.
+        """
+        self.fname = fname
+        self._scan = scan
+        # Block origin to its constant value, or None if it has a file:
+        self._blocks: Dict[Tuple[int, int, int], Optional[Value]] = {}
+        self._offset = 0
+        self._loaded = False
+        self._lock = threading.Lock()
+
+    def _append(self, blocks: Iterable[Tuple[int, int, int]], value: Value = None):
+        if value is None:
+            lines = "".join("{},{},{}\n".format(*b) for b in blocks)
+        else:
+            lines = "".join("{},{},{}={!r}\n".format(*b, value) for b in blocks)
+        if not lines:
+            return
+        fd = os.open(self.fname, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        try:
+            os.write(fd, lines.encode())
+        finally:
+            os.close(fd)
+
+    def _refresh(self):
+        """
+        Read any lines that have been appended since the last read.
+
+        Must be called with the lock held.
+        """
+        if not self._loaded:
+            self._loaded = True
+            if (
+                not os.path.isfile(self.fname)
+                and self._scan is not None
+                and os.path.isdir(os.path.dirname(self.fname))
+            ):
+                self._append(self._scan())
+        try:
+            if os.stat(self.fname).st_size <= self._offset:
+                return
+            with open(self.fname, "rb") as fh:
+                fh.seek(self._offset)
+                tail = fh.read()
+        except FileNotFoundError:
+            return
+        # Only consume complete lines:
+        end = tail.rfind(b"\n") + 1
+        for line in tail[:end].splitlines():
+            if line:
+                origin, _, value = line.partition(b"=")
+                self._blocks[tuple(int(v) for v in origin.split(b","))] = (
+                    _parse_value(value) if value else None
+                )
+        self._offset += end
+
+    def __contains__(self, b: Tuple[int, int, int]) -> bool:
+        b = tuple(b)
+        with self._lock:
+            if b in self._blocks:
+                return True
+            self._refresh()
+            return b in self._blocks
+
+    def add(self, b: Tuple[int, int, int], value: Value = None):
+        """
+        Record that a block is present.
+
+        Arguments:
+            b: The origin of the block
+            value: The value of every voxel of the block, if it is constant
+                and so has no block file
+
+        """
+        b = tuple(b)
+        with self._lock:
+            if not self._loaded:
+                self._refresh()
+            if b in self._blocks and self._blocks[b] == value:
+                return
+            self._append([b], value)
+            self._blocks[b] = value
+
+    def constant(self, b: Tuple[int, int, int]) -> Optional[Value]:
+        """
+        Get the value of a constant block, or None if it has a block file.
+
+        Arguments:
+            b: The origin of the block
+
+        """
+        with self._lock:
+            return self._blocks.get(tuple(b))
+
+    def refresh(self):
+        """
+        Read any lines that other writers have appended.
+
+        Lookups of missing blocks do this on their own, but a block that is
+        present may have changed between constant and stored since.
+        """
+        with self._lock:
+            self._refresh()
+
+    def blocks(self) -> Set[Tuple[int, int, int]]:
+        """
+        Get the origins of all of the blocks that are present.
+
+        Returns:
+            Set[Tuple[int, int, int]]
+
+        """
+        with self._lock:
+            self._refresh()
+            return set(self._blocks)
+
+
+def _parse_value(value: bytes) -> Value:
+    try:
+        return int(value)
+    except ValueError:
+        return float(value)
@@ -0,0 +1,767 @@
+"""
+Copyright 2018 The Johns Hopkins University Applied Physics Laboratory.
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+from typing import Iterable, Optional, Tuple, List
+from abc import ABC, abstractmethod
+
+import io
+import json
+import logging
+import os
+import re
+import struct
+import threading
+
+import blosc
+import numpy as np
+
+from ._BlockLocks import BlockLocks
+from ._BlockManifest import BlockManifest
+
+log = logging.getLogger(__name__)
+
+
+class ChunkedFileInterface(ABC):
+    """
+    A filesystem manager that handles transit from numpy in-memory to a
+    static format on disk.
+    """
+
+    format_name = "None"
+    extension = None
+    # The memory layout that blocks are cheapest to store from:
+    order = "C"
+
+    def __init__(self, storage_path: str, block_size) -> None:
+        self.storage_path = storage_path
+        self.block_size = block_size
+        self._manifests = {}
+        self._manifests_lock = threading.Lock()
+        self._dtypes = {}
+        self._channel_dirs = set()
+
+    def manifest(self, col: str, exp: str, chan: str, res: int) -> BlockManifest:
+        """
+        Get the manifest of present blocks for a channel and resolution.
+
+        Arguments:
+            col, exp, chan, res
+
+        Returns:
+            BlockManifest
+
+        """
+        key = (col, exp, chan, res)
+        with self._manifests_lock:
+            if key not in self._manifests:
+                self._manifests[key] = BlockManifest(
+                    "{}/{}/{}/{}/{}.manifest".format(
+                        self.storage_path, col, exp, chan, res
+                    ),
+                    scan=lambda: self.list_blocks(col, exp, chan, res),
+                )
+            return self._manifests[key]
+
+    def make_channel_dir(self, col: str, exp: str, chan: str):
+        """
+        Create the directory for a channel, once per process.
+        """
+        if (col, exp, chan) in self._channel_dirs:
+            return
+        os.makedirs(
+            "{}/{}/{}/{}/".format(self.storage_path, col, exp, chan), exist_ok=True
+        )
+        self._channel_dirs.add((col, exp, chan))
+
+    def _metadata_fname(self, col: str, exp: str, chan: str) -> str:
+        return "{}/{}/{}/{}/metadata.json".format(self.storage_path, col, exp, chan)
+
+    def get_dtype(self, col: str, exp: str, chan: str) -> Optional[str]:
+        """
+        Get the datatype recorded for a channel, or None if there isn't one.
+        """
+        key = (col, exp, chan)
+        if key not in self._dtypes:
+            try:
+                with open(self._metadata_fname(col, exp, chan)) as fh:
+                    self._dtypes[key] = json.load(fh).get("datatype")
+            except FileNotFoundError:
+                return None
+        return self._dtypes[key]
+
+    def set_dtype(self, col: str, exp: str, chan: str, dtype: str):
+        """
+        Record the datatype of a channel.
+        """
+        dtype = np.dtype(dtype).name
+        if self.get_dtype(col, exp, chan) == dtype:
+            return
+        fname = self._metadata_fname(col, exp, chan)
+        self.make_channel_dir(col, exp, chan)
+        self._atomic_write(
+            fname, lambda fh: fh.write(json.dumps({"datatype": dtype}).encode())
+        )
+        self._dtypes[(col, exp, chan)] = dtype
+
+    @staticmethod
+    def _atomic_write(fname: str, write):
+        """
+        Write a file by calling `write(fh)` on a temporary file, and then
+        renaming it into place, so that readers never see a partial file.
+        """
+        tmp = "{}.{}-{}.tmp".format(fname, os.getpid(), threading.get_ident())
+        try:
+            with open(tmp, "wb") as fh:
+                write(fh)
+            os.replace(tmp, fname)
+        except BaseException:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            raise
+
+    def hasfile(
+        self, col: str, exp: str, chan: str, res: int, b: Tuple[int, int, int]
+    ) -> bool:
+        """
+        Check whether a block is present, without touching the disk.
+        """
+        return tuple(b) in self.manifest(col, exp, chan, res)
+
+    def constant(
+        self, col: str, exp: str, chan: str, res: int, b: Tuple[int, int, int]
+    ):
+        """
+        Get the value of a block that is stored as a constant, or None.
+        """
+        return self.manifest(col, exp, chan, res).constant(b)
+
+    def store_constant(
+        self, value, col: str, exp: str, chan: str, res: int, b: Tuple[int, int, int]
+    ):
+        """
+        Record that every voxel of a block holds `value`, without a file.
+
+        Any file that the block had before is left in place, since other
+        processes may still be reading it, and is ignored from then on.
+        """
+        self.make_channel_dir(col, exp, chan)
+        self.manifest(col, exp, chan, res).add(b, value)
+
+    def refresh(self, col: str, exp: str, chan: str, res: int):
+        """
+        Catch up with blocks that other processes have stored since.
+        """
+        self.manifest(col, exp, chan, res).refresh()
+
+    def _block_fname(
+        self, col: str, exp: str, chan: str, res: int, b: Tuple[int, int, int]
+    ) -> str:
+        return "{}/{}/{}/{}/{}-{}-{}-{}.{}".format(
+            self.storage_path,
+            col,
+            exp,
+            chan,
+            res,
+            (b[0], b[0] + self.block_size[0]),
+            (b[1], b[1] + self.block_size[1]),
+            (b[2], b[2] + self.block_size[2]),
+            self.extension,
+        )
+
+    def list_blocks(
+        self, col: str, exp: str, chan: str, res: int
+    ) -> Iterable[Tuple[int, int, int]]:
+        """
+        Scan the disk for the origins of the blocks that are present.
+
+        This is only used to build a manifest for a channel that doesn't
+        have one yet.
+        """
+        bounds = r"\((-?\d+), -?\d+\)"
+        pattern = re.compile(
+            r"^{}-{b}-{b}-{b}\.{}$".format(
+                re.escape(str(res)), re.escape(self.extension), b=bounds
+            )
+        )
+        channel_path = "{}/{}/{}/{}".format(self.storage_path, col, exp, chan)
+        for fname in os.listdir(channel_path):
+            match = pattern.match(fname)
+            if match:
+                yield tuple(int(v) for v in match.groups())
+
+    @abstractmethod
+    def store(
+        self,
+        data: np.array,
+        col: str,
+        exp: str,
+        chan: str,
+        res: int,
+        b: Tuple[int, int, int],
+    ):
+        ...
+
+    @abstractmethod
+    def retrieve(
+        self,
+        col: str,
+        exp: str,
+        chan: str,
+        res: int,
+        b: Tuple[int, int, int],
+        window: List[Tuple[int, int]] = None,
+    ):
+        """
+        Pull a single block (or a window of it) from disk.
+
+        If `window` is given, it is a list of three (start, stop) pairs in
+        block-local coordinates, and only that sub-region is returned.
+        """
+        ...
+
+
+class NpyChunkedFileInterface(ChunkedFileInterface):
+    extension = "npy"
+
+    def __init__(
+        self,
+        storage_path: str,
+        block_size,
+        use_mmap: bool = True,
+        order: str = "F",
+    ):
+        """
+        Create a new NpyChunkedFileInterface.
+
+        Arguments:
+            storage_path: Where to store the data tree
+            block_size: How much data should go in each file
+            use_mmap (bool: True): Memory-map block files when only a window
+                of the block is requested, so that only the pages that hold
+                the window are read from disk
+            order (str: "F"): Memory layout of new block files. "F" keeps
+                each z-plane contiguous on disk, which makes z-slab reads
+                cheap. Existing files are read in whatever order they were
+                written in.
+        """
+        super().__init__(storage_path, block_size)
+        self.use_mmap = use_mmap
+        self.order = order
+        self.format_name = "NPY"
+
+    def __repr__(self):
+        return f"<NpyChunkedFileInterface>"
+
+    def store(
+        self,
+        data: np.array,
+        col: str,
+        exp: str,
+        chan: str,
+        res: int,
+        b: Tuple[int, int, int],
+    ):
+        """
+        Store a single block file.
+
+        Arguments:
+            data (np.array)
+            bossURI
+
+        """
+        self.make_channel_dir(col, exp, chan)
+        fname = self._block_fname(col, exp, chan, res, b)
+        if self.order == "F":
+            data = np.asfortranarray(data)
+        self._atomic_write(fname, lambda fh: np.save(fh, data))
+        self.manifest(col, exp, chan, res).add(b)
+
+    def retrieve(
+        self,
+        col: str,
+        exp: str,
+        chan: str,
+        res: int,
+        b: Tuple[int, int, int],
+        window: List[Tuple[int, int]] = None,
+    ):
+        """
+        Pull a single block from disk.
+
+        Arguments:
+            bossURI
+            window: Optional block-local (start, stop) bounds for each axis
+
+        """
+        if not (
+            os.path.isdir("{}/{}".format(self.storage_path, col))
+            and os.path.isdir("{}/{}/{}".format(self.storage_path, col, exp))
+            and os.path.isdir("{}/{}/{}/{}".format(self.storage_path, col, exp, chan))
+        ):
+            raise IOError("{}/{}/{} not found.".format(col, exp, chan))
+        fname = self._block_fname(col, exp, chan, res, b)
+        if window is None:
+            return np.load(fname)
+        if not self.use_mmap:
+            return np.load(fname)[
+                window[0][0] : window[0][1],
+                window[1][0] : window[1][1],
+                window[2][0] : window[2][1],
+            ]
+        block = np.load(fname, mmap_mode="r")
+        # Copy out of the map so that the file is released once `block` goes
+        # out of scope:
+        return np.array(
+            block[
+                window[0][0] : window[0][1],
+                window[1][0] : window[1][1],
+                window[2][0] : window[2][1],
+            ]
+        )
+
+
+class BloscChunkedFileInterface(ChunkedFileInterface):
+    """
+    Stores each block as a single blosc-compressed buffer.
+
+    Each file holds a 4-byte little-endian header length, a JSON header with
+    the dtype, shape and memory order of the block, and then the compressed
+    block.
+    """
+
+    extension = "blosc"
+
+    def __init__(
+        self,
+        storage_path: str,
+        block_size,
+        codec: str = "zstd",
+        clevel: int = 5,
+        shuffle: int = blosc.SHUFFLE,
+        nthreads: int = None,
+    ):
+        """
+        Create a new BloscChunkedFileInterface.
+
+        Arguments:
+            storage_path: Where to store the data tree
+            block_size: How much data should go in each file
+            codec (str: "zstd"): The blosc compressor (see `blosc.cnames`)
+            clevel (int: 5): Compression level, from 0 to 9
+            shuffle (int: blosc.SHUFFLE): One of blosc.NOSHUFFLE,
+                blosc.SHUFFLE or blosc.BITSHUFFLE
+            nthreads (int): Number of threads blosc uses. This setting is
+                global to the process. Leave unset to keep blosc's default.
+        """
+        super().__init__(storage_path, block_size)
+        if codec not in blosc.cnames:
+            raise ValueError(
+                "Unknown blosc codec {}. Choose from {}.".format(codec, blosc.cnames)
+            )
+        self.codec = codec
+        self.clevel = clevel
+        self.shuffle = shuffle
+        if nthreads is not None:
+            blosc.set_nthreads(nthreads)
+        self.format_name = "blosc"
+
+    def __repr__(self):
+        return f"<BloscChunkedFileInterface [{self.codec}]>"
+
+    def store(
+        self,
+        data: np.array,
+        col: str,
+        exp: str,
+        chan: str,
+        res: int,
+        b: Tuple[int, int, int],
+    ):
+        """
+        Store a single block file.
+
+        Arguments:
+            data (np.array)
+            bossURI
+
+        """
+        self.make_channel_dir(col, exp, chan)
+        # Blocks are compressed in whichever order they are already in, so
+        # that uploads (which arrive as transposed views) aren't copied:
+        fortran_order = data.flags.f_contiguous and not data.flags.c_contiguous
+        data = np.asfortranarray(data) if fortran_order else np.ascontiguousarray(data)
+        header = json.dumps(
+            {
+                "dtype": data.dtype.str,
+                "shape": list(data.shape),
+                "fortran_order": fortran_order,
+            }
+        ).encode()
+        compressed = blosc.compress_ptr(
+            data.__array_interface__["data"][0],
+            data.size,
+            typesize=data.dtype.itemsize,
+            clevel=self.clevel,
+            shuffle=self.shuffle,
+            cname=self.codec,
+        )
+        self._atomic_write(
+            self._block_fname(col, exp, chan, res, b),
+            lambda fh: fh.write(struct.pack("<I", len(header)) + header + compressed),
+        )
+        self.manifest(col, exp, chan, res).add(b)
+
+    def retrieve(
+        self,
+        col: str,
+        exp: str,
+        chan: str,
+        res: int,
+        b: Tuple[int, int, int],
+        window: List[Tuple[int, int]] = None,
+    ):
+        """
+        Pull a single block from disk.
+
+        The whole block is always decompressed; `window` only limits what is
+        returned.
+
+        Arguments:
+            bossURI
+            window: Optional block-local (start, stop) bounds for each axis
+
+        """
+        fname = self._block_fname(col, exp, chan, res, b)
+        if not os.path.isfile(fname):
+            raise IOError("{}/{}/{} block {} not found.".format(col, exp, chan, b))
+        with open(fname, "rb") as fh:
+            (header_length,) = struct.unpack("<I", fh.read(4))
+            header = json.loads(fh.read(header_length).decode())
+            compressed = fh.read()
+        block = np.empty(
+            header["shape"],
+            dtype=np.dtype(header["dtype"]),
+            order="F" if header.get("fortran_order") else "C",
+        )
+        blosc.decompress_ptr(compressed, block.__array_interface__["data"][0])
+        if window is None:
+            return block
+        return block[
+            window[0][0] : window[0][1],
+            window[1][0] : window[1][1],
+            window[2][0] : window[2][1],
+        ]
+
+
+class ShardedChunkedFileInterface(ChunkedFileInterface):
+    """
+    Packs a grid of blocks into each shard file.
+
+    A shard holds up to `shard_shape` blocks, each stored as a complete
+    `.npy` record. Writes append the new record, then a new index, then a
+    fixed-size trailer that points at the index:
+
+        [record][record]...[index][trailer]
+
+    The index is an array of (x, y, z, offset, length) rows, one per block.
+    Records and old indices are never modified in place, so a reader that
+    holds an older index still reads valid data. Overwritten records are
+    left behind as dead space, until more than `compact_ratio` of the shard
+    is dead. Then the live records are copied into a new shard, which is
+    renamed into place; readers that have the old one open carry on reading
+    it.
+
+    Indices are cached per shard and re-read only when the shard has changed,
+    so reading a block costs one open and one pread. Writers to the same
+    shard are serialized with a lock that works across processes.
+    """
+
+    extension = "shard"
+    _MAGIC = b"BSPSHARD"
+    _TRAILER = struct.Struct("<8sQQ")
+    _ROW_SIZE = 5 * 8
+    # How much of a damaged shard to read at a time, looking for its trailer:
+    _SCAN_SIZE = 2 ** 20
+
+    def __init__(
+        self,
+        storage_path: str,
+        block_size,
+        shard_shape: Tuple[int, int, int] = (8, 8, 8),
+        compact_ratio: float = 0.5,
+    ):
+        """
+        Create a new ShardedChunkedFileInterface.
+
+        Arguments:
+            storage_path: Where to store the data tree
+            block_size: How much data should go in each block
+            shard_shape ((int, int, int): (8, 8, 8)): How many blocks along
+                each axis go in each shard file
+            compact_ratio (float: 0.5): Rewrite a shard once more than this
+                fraction of it is dead space
+        """
+        super().__init__(storage_path, block_size)
+        self.shard_shape = shard_shape
+        self.compact_ratio = compact_ratio
+        self.format_name = "sharded"
+        self._indices = {}
+        self._indices_lock = threading.Lock()
+        self._shard_locks = BlockLocks(storage_path, lock_name=".shardlocks")
+
+    def __repr__(self):
+        return f"<ShardedChunkedFileInterface {tuple(self.shard_shape)}>"
+
+    def _shard_fname(
+        self, col: str, exp: str, chan: str, res: int, b: Tuple[int, int, int]
+    ) -> str:
+        shard = [b[n] // (self.block_size[n] * self.shard_shape[n]) for n in range(3)]
+        return "{}/{}/{}/{}/{}-{}-{}-{}.{}".format(
+            self.storage_path, col, exp, chan, res, *shard, self.extension
+        )
+
+    def _find_index(self, fd: int, size: int) -> Tuple[int, dict]:
+        """
+        Find the last complete index of an open shard.
+
+        The trailer is normally at the very end. If the last append was cut
+        short (e.g. by a crash), the file is scanned backwards for the last
+        trailer that points at the index just before it.
+
+        Returns:
+            The length of the shard up to the end of that trailer, and the
+            index. (0, {}) if the shard has no complete index at all.
+
+        """
+        trailer_size = self._TRAILER.size
+        if size >= trailer_size:
+            # Usually, the trailer is where it should be:
+            found = self._parse_trailer(
+                fd, size - trailer_size, os.pread(fd, trailer_size, size - trailer_size)
+            )
+            if found is not None:
+                return found
+        end = size
+        while end > 0:
+            start = max(end - self._SCAN_SIZE, 0)
+            # Read a trailer's length past `end`, so that trailers straddling
+            # the boundary are found too:
+            buf = os.pread(fd, min(end + trailer_size, size) - start, start)
+            limit = len(buf)
+            while True:
+                at = buf.rfind(self._MAGIC, 0, limit)
+                if at < 0:
+                    break
+                found = self._parse_trailer(fd, start + at, buf[at : at + trailer_size])
+                if found is not None:
+                    return found
+                limit = at + len(self._MAGIC) - 1
+            end = start
+        return 0, {}
+
+    def _parse_trailer(
+        self, fd: int, position: int, trailer: bytes
+    ) -> Optional[Tuple[int, dict]]:
+        """
+        Read the index that a trailer points at, if it is a valid trailer.
+        """
+        if len(trailer) != self._TRAILER.size:
+            return None
+        magic, offset, length = self._TRAILER.unpack(trailer)
+        # The index is always written just before its trailer:
+        if (
+            magic != self._MAGIC
+            or offset + length != position
+            or length % self._ROW_SIZE
+        ):
+            return None
+        rows = np.frombuffer(os.pread(fd, length, offset), dtype="<i8").reshape(-1, 5)
+        index = {tuple(row[:3]): (row[3], row[4]) for row in rows.tolist()}
+        return position + self._TRAILER.size, index
+
+    def _read_index(self, fd: int, fname: str) -> Tuple[int, dict]:
+        """
+        Get the {block origin: (offset, length)} index of an open shard.
+
+        Returns:
+            The length of the shard up to the end of the index's trailer, and
+            the index
+
+        """
+        stat = os.fstat(fd)
+        # A compacted shard is a new file, which may happen to be the same
+        # size as the old one:
+        version = (stat.st_ino, stat.st_size)
+        with self._indices_lock:
+            cached = self._indices.get(fname)
+        if cached is not None and cached[0] == version:
+            return cached[1], cached[2]
+        end, index = self._find_index(fd, stat.st_size)
+        if end == stat.st_size:
+            # Only a complete shard is cached. While another writer is
+            # partway through an append, the shard may already have its final
+            # size, and the index found before the append would otherwise be
+            # kept after it has finished.
+            with self._indices_lock:
+                self._indices[fname] = (version, end, index)
+        return end, index
+
+    def list_blocks(
+        self, col: str, exp: str, chan: str, res: int
+    ) -> Iterable[Tuple[int, int, int]]:
+        pattern = re.compile(
+            r"^{}-(-?\d+)-(-?\d+)-(-?\d+)\.{}$".format(
+                re.escape(str(res)), re.escape(self.extension)
+            )
+        )
+        channel_path = "{}/{}/{}/{}".format(self.storage_path, col, exp, chan)
+        for fname in os.listdir(channel_path):
+            if not pattern.match(fname):
+                continue
+            fname = "{}/{}".format(channel_path, fname)
+            fd = os.open(fname, os.O_RDONLY)
+            try:
+                yield from self._read_index(fd, fname)[1]
+            finally:
+                os.close(fd)
+
+    def store(
+        self,
+        data: np.array,
+        col: str,
+        exp: str,
+        chan: str,
+        res: int,
+        b: Tuple[int, int, int],
+    ):
+        """
+        Append a single block to its shard.
+
+        Arguments:
+            data (np.array)
+            bossURI
+
+        """
+        self.make_channel_dir(col, exp, chan)
+        record = io.BytesIO()
+        np.save(record, data)
+        record = record.getvalue()
+
+        fname = self._shard_fname(col, exp, chan, res, b)
+        # Appends to one shard must not interleave, in this process or any
+        # other:
+        with self._shard_locks.lock(col, exp, chan, fname):
+            fd = os.open(fname, os.O_RDWR | os.O_CREAT, 0o644)
+            try:
+                length = os.fstat(fd).st_size
+                size, index = self._find_index(fd, length)
+                if size != length:
+                    # The last append to this shard was cut short, and nothing
+                    # points at what it left behind:
+                    log.warning("Truncating incomplete append to %s", fname)
+                    os.ftruncate(fd, size)
+                index[tuple(b)] = (size, len(record))
+                rows = np.array(
+                    [[*k, *v] for k, v in index.items()], dtype="<i8"
+                ).tobytes()
+                trailer = self._TRAILER.pack(self._MAGIC, size + len(record), len(rows))
+                os.pwrite(fd, record + rows + trailer, size)
+                end = size + len(record) + len(rows) + len(trailer)
+                live = sum(n for _, n in index.values()) + len(rows) + len(trailer)
+                if end - live > self.compact_ratio * end:
+                    end, index = self._compact(fd, fname, index)
+                stat = os.stat(fname)
+                with self._indices_lock:
+                    self._indices[fname] = ((stat.st_ino, end), end, index)
+            finally:
+                os.close(fd)
+        self.manifest(col, exp, chan, res).add(b)
+
+    def _compact(self, fd: int, fname: str, index: dict) -> Tuple[int, dict]:
+        """
+        Rewrite a shard with only its live records.
+
+        Must be called with the shard's lock held.
+
+        Returns:
+            The length of the new shard, and its index
+
+        """
+        compacted = {}
+
+        def _write(fh):
+            offset = 0
+            # Records are copied in the order they were written, one at a
+            # time, so that the shard is never held in memory:
+            for key, (at, length) in sorted(index.items(), key=lambda kv: kv[1]):
+                fh.write(os.pread(fd, length, at))
+                compacted[key] = (offset, length)
+                offset += length
+            rows = np.array(
+                [[*k, *v] for k, v in compacted.items()], dtype="<i8"
+            ).tobytes()
+            fh.write(rows + self._TRAILER.pack(self._MAGIC, offset, len(rows)))
+
+        self._atomic_write(fname, _write)
+        log.debug("Compacted %s", fname)
+        return os.stat(fname).st_size, compacted
+
+    def retrieve(
+        self,
+        col: str,
+        exp: str,
+        chan: str,
+        res: int,
+        b: Tuple[int, int, int],
+        window: List[Tuple[int, int]] = None,
+    ):
+        """
+        Pull a single block from its shard.
+
+        Arguments:
+            bossURI
+            window: Optional block-local (start, stop) bounds for each axis
+
+        """
+        fname = self._shard_fname(col, exp, chan, res, b)
+        try:
+            fd = os.open(fname, os.O_RDONLY)
+        except FileNotFoundError as e:
+            raise IOError(
+                "{}/{}/{} block {} not found.".format(col, exp, chan, b)
+            ) from e
+        try:
+            _, index = self._read_index(fd, fname)
+            if tuple(b) not in index:
+                raise IOError("{}/{}/{} block {} not found.".format(col, exp, chan, b))
+            offset, length = index[tuple(b)]
+            record = os.pread(fd, length, offset)
+        finally:
+            os.close(fd)
+        block = np.load(io.BytesIO(record))
+        if window is None:
+            return block
+        return block[
+            window[0][0] : window[0][1],
+            window[1][0] : window[1][1],
+            window[2][0] : window[2][1],
+        ]
+
+
+CHUNKED_FILE_FORMATS = {
+    "npy": NpyChunkedFileInterface,
+    "blosc": BloscChunkedFileInterface,
+    "sharded": ShardedChunkedFileInterface,
+}
@@ -13,121 +13,47 @@ WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 See the License for the specific language governing permissions and
 limitations under the License.
 """
-from typing import Tuple, List
-from abc import ABC, abstractmethod
+from typing import Optional, Tuple, List
+from concurrent.futures import Future, ThreadPoolExecutor
+
+import threading
 
-import os
 import numpy as np
 
 from .StorageManager import StorageManager
-from .utils import file_compute, blockfile_indices
-
-
-class ChunkedFileInterface(ABC):
+from ._BlockLocks import BlockLocks
+from ._ChunkedFileInterfaces import (  # pylint: disable=unused-import
+    CHUNKED_FILE_FORMATS,
+    BloscChunkedFileInterface,
+    ChunkedFileInterface,
+    NpyChunkedFileInterface,
+    ShardedChunkedFileInterface,
+)
+from ._Prefetcher import Prefetcher
+from .utils import block_plan, bounded_map, fetch_block
+
+# Channels that were written before datatypes were recorded are all uint8:
+DEFAULT_DTYPE = "uint8"
+
+
+def constant_value(data: np.array):
     """
-    A filesystem manager that handles transit from numpy in-memory to a
-    static format on disk.
-    """
-
-    format_name = "None"
-
-    @abstractmethod
-    def store(
-        self,
-        data: np.array,
-        col: str,
-        exp: str,
-        chan: str,
-        res: int,
-        b: Tuple[int, int, int],
-    ):
-        ...
-
-    @abstractmethod
-    def retrieve(
-        self, col: str, exp: str, chan: str, res: int, b: Tuple[int, int, int]
-    ):
-        ...
-
-
-class NpyChunkedFileInterface(ChunkedFileInterface):
-    def __init__(self, storage_path: str, block_size):
-        self.storage_path = storage_path
-        self.block_size = block_size
-        self.format_name = "NPY"
-
-    def __repr__(self):
-        return f"<NpyChunkedFileInterface>"
-
-    def store(
-        self,
-        data: np.array,
-        col: str,
-        exp: str,
-        chan: str,
-        res: int,
-        b: Tuple[int, int, int],
-    ):
-        """
-        Store a single block file.
-
-        Arguments:
-            data (np.array)
-            bossURI
-
-        """
-        os.makedirs(
-            "{}/{}/{}/{}/".format(self.storage_path, col, exp, chan), exist_ok=True
-        )
-        fname = "{}/{}/{}/{}/{}-{}-{}-{}.npy".format(
-            self.storage_path,
-            col,
-            exp,
-            chan,
-            res,
-            (b[0], b[0] + self.block_size[0]),
-            (b[1], b[1] + self.block_size[1]),
-            (b[2], b[2] + self.block_size[2]),
-        )
-        return np.save(fname, data)
-
-    def hasfile(self, col: str, exp: str, chan: str, res: int, b: Tuple[int, int, int]) -> bool:
-        if not (
-            os.path.isdir("{}/{}".format(self.storage_path, col))
-            and os.path.isdir("{}/{}/{}".format(self.storage_path, col, exp))
-            and os.path.isdir("{}/{}/{}/{}".format(self.storage_path, col, exp, chan))
-        ):
-            return False
-        return True
-
-
-    def retrieve(
-        self, col: str, exp: str, chan: str, res: int, b: Tuple[int, int, int]
-    ):
-        """
-        Pull a single block from disk.
+    Get the value of every voxel of an array, if they are all the same.
 
-        Arguments:
-            bossURI
+    Returns:
+        int or float: The value, or None if the voxels differ (or the data
+            aren't integers, floats or booleans)
 
-        """
-        if not (
-            os.path.isdir("{}/{}".format(self.storage_path, col))
-            and os.path.isdir("{}/{}/{}".format(self.storage_path, col, exp))
-            and os.path.isdir("{}/{}/{}/{}".format(self.storage_path, col, exp, chan))
-        ):
-            raise IOError("{}/{}/{} not found.".format(col, exp, chan))
-        fname = "{}/{}/{}/{}/{}-{}-{}-{}.npy".format(
-            self.storage_path,
-            col,
-            exp,
-            chan,
-            res,
-            (b[0], b[0] + self.block_size[0]),
-            (b[1], b[1] + self.block_size[1]),
-            (b[2], b[2] + self.block_size[2]),
-        )
-        return np.load(fname)
+    """
+    if data.size == 0 or data.dtype.kind not in "biuf":
+        return None
+    first = data.flat[0]
+    # Most blocks that aren't constant differ at their far corner, which
+    # saves comparing every voxel:
+    if data.flat[-1] != first or not (data == first).all():
+        return None
+    value = first.item()
+    return value if isinstance(value, float) else int(value)
 
 
 class ChunkedFilesystemStorageManager(StorageManager):
@@ -146,7 +72,24 @@ class ChunkedFilesystemStorageManager(StorageManager):
         Arguments:
             storage_path: Where to store the data tree
             block_size: How much data should go in each file
-            preferred_format (str: npy): file format you prefer to use on disk
+            preferred_format (str: npy): file format you prefer to use on disk,
+                one of "npy", "blosc" or "sharded"
+            format_options (dict): Extra arguments for the file format, e.g.
+                {"codec": "lz4", "clevel": 9} for blosc
+            workers (int: 1): Number of threads used to read blocks in
+                parallel during `getdata`. 1 reads blocks serially.
+            max_inflight (int: 2 * workers): Largest number of block reads
+                that may be outstanding at once
+            cache (bool: True): Whether to store blocks fetched from the
+                next layer, so that repeat reads are served locally
+            prefetch (int: 0): When reads move steadily in one direction,
+                fetch this many layers of blocks ahead of them from the next
+                layer in the background. 0 turns read-ahead off.
+            prefetch_workers (int: 2): Threads that fetch blocks ahead
+            prefetch_queue (int: 64): The most blocks to queue for read-ahead
+            sparse (bool: True): Record blocks whose voxels all hold the same
+                value (e.g. empty space) in the manifest instead of writing
+                them to disk, and fill them in without reading on `getdata`
         """
         self.name = "ChunkedFilesystemStorageManager"
         if "next_layer" in kwargs:
@@ -156,10 +99,41 @@ class ChunkedFilesystemStorageManager(StorageManager):
             self.is_terminal = True
         self.storage_path = storage_path
         self.block_size = block_size
+        self._cache = kwargs.get("cache", True)
+        self.sparse = kwargs.get("sparse", True)
+
+        preferred_format = kwargs.get("preferred_format", "npy")
+        if preferred_format not in CHUNKED_FILE_FORMATS:
+            raise ValueError(
+                "Unknown format {}. Choose from {}.".format(
+                    preferred_format, list(CHUNKED_FILE_FORMATS)
+                )
+            )
+        self.fs = CHUNKED_FILE_FORMATS[preferred_format](
+            self.storage_path, self.block_size, **kwargs.get("format_options", {})
+        )
 
-        self.fs = (
-            {"npy": NpyChunkedFileInterface}.get(kwargs.get("preferred_format", "npy"))
-        )(self.storage_path, self.block_size)
+        self._locks = BlockLocks(self.storage_path)
+        # Fetches from the next layer that are under way, by block:
+        self._inflight = {}
+        self._inflight_lock = threading.Lock()
+
+        self._prefetcher = None
+        if kwargs.get("prefetch", 0) and self._cache and not self.is_terminal:
+            self._prefetcher = Prefetcher(
+                self._fetch_shared,
+                self.fs.hasfile,
+                self.block_size,
+                depth=kwargs["prefetch"],
+                workers=kwargs.get("prefetch_workers", 2),
+                max_queued=kwargs.get("prefetch_queue", 64),
+            )
+
+        self.workers = kwargs.get("workers", 1)
+        self.max_inflight = kwargs.get("max_inflight", 2 * self.workers)
+        self._pool = (
+            ThreadPoolExecutor(max_workers=self.workers) if self.workers > 1 else None
+        )
 
     def hasdata(
         self,
@@ -171,13 +145,21 @@ class ChunkedFilesystemStorageManager(StorageManager):
         ys: Tuple[int, int],
         zs: Tuple[int, int],
     ):
-        # TODO: Should know when it has data and return false even if it's
-        # in terminal mode
-        try:
-            self.getdata(col, exp, chan, res, xs, ys, zs)
-        except:
+        """
+        Check whether every block of the volume is present.
+
+        This only consults the block manifest, and never reads data.
+
+        Arguments:
+            bossURI
+
+        """
+        files = block_plan(xs, ys, zs, block_size=self.block_size).origins.tolist()
+        if all(self.fs.hasfile(col, exp, chan, res, f) for f in files):
+            return True
+        if self.is_terminal:
             return False
-        return self.is_terminal
+        return self._next.hasdata(col, exp, chan, res, xs, ys, zs)
 
     def setdata(
         self,
@@ -196,26 +178,129 @@ class ChunkedFilesystemStorageManager(StorageManager):
         Arguments:
             bossURI
         """
+        self._write(data, None, col, exp, chan, res, xs, ys, zs)
+
+    def setdata_masked(
+        self,
+        data: np.array,
+        mask: np.array,
+        col: str,
+        exp: str,
+        chan: str,
+        res: int,
+        xs: Tuple[int, int],
+        ys: Tuple[int, int],
+        zs: Tuple[int, int],
+    ):
+        """
+        Upload only the voxels of the data where `mask` is True.
+
+        Each block is merged under its lock, as in `setdata`, so concurrent
+        writes from other threads and processes are kept.
+
+        Arguments:
+            data: The data to write
+            mask: A boolean array of the same shape as `data`
+            bossURI
+        """
+        self._write(data, mask, col, exp, chan, res, xs, ys, zs)
+
+    def _write(
+        self,
+        data: np.array,
+        mask: Optional[np.array],
+        col: str,
+        exp: str,
+        chan: str,
+        res: int,
+        xs: Tuple[int, int],
+        ys: Tuple[int, int],
+        zs: Tuple[int, int],
+    ):
+        dtype = self.fs.get_dtype(col, exp, chan)
+        if dtype is None:
+            self.fs.set_dtype(col, exp, chan, data.dtype)
+        elif np.dtype(dtype) != data.dtype:
+            raise ValueError(
+                "Channel {}/{}/{} holds {} data, not {}.".format(
+                    col, exp, chan, dtype, data.dtype
+                )
+            )
+
         # Chunk the file into its parts
-        files = file_compute(
-            xs[0], xs[1], ys[0], ys[1], zs[0], zs[1], block_size=self.block_size
-        )
-        indices = blockfile_indices(xs, ys, zs, block_size=self.block_size)
+        plan = block_plan(xs, ys, zs, block_size=self.block_size)
+
+        full = [[0, size] for size in self.block_size]
+        self.fs.make_channel_dir(col, exp, chan)
+        for f, i, p in plan.blocks():
+            block_data = data[p[0][0] : p[0][1], p[1][0] : p[1][1], p[2][0] : p[2][1]]
+            block_mask = None
+            if mask is not None:
+                block_mask = mask[
+                    p[0][0] : p[0][1], p[1][0] : p[1][1], p[2][0] : p[2][1]
+                ]
+                if not block_mask.any():
+                    continue
+                if block_mask.all():
+                    block_mask = None
+            # Hold the block's lock across the read-modify-write, so that
+            # concurrent uploads to the same block can't lose each other's
+            # data:
+            with self._locks.lock(col, exp, chan, res, f):
+                if i == full and block_mask is None:
+                    # The upload covers the whole block, so there is nothing
+                    # to keep from the old one:
+                    self._store_block(block_data, col, exp, chan, res, f)
+                    continue
+                # Another process may have changed the block since this one
+                # last looked, so the manifest must be current:
+                self.fs.refresh(col, exp, chan, res)
+                value = self.fs.constant(col, exp, chan, res, f)
+                if value is not None:
+                    written = block_data
+                    if block_mask is not None:
+                        written = block_data[block_mask]
+                    if self.sparse and constant_value(written) == value:
+                        continue
+                    data_partial = np.full(
+                        self.block_size, value, dtype=data.dtype, order=self.fs.order
+                    )
+                elif self.fs.hasfile(col, exp, chan, res, f):
+                    data_partial = self.fs.retrieve(col, exp, chan, res, f)
+                else:
+                    data_partial = np.zeros(
+                        self.block_size, dtype=data.dtype, order=self.fs.order
+                    )
 
-        for f, i in zip(files, indices):
-            try:
-                data_partial = self.fs.retrieve(col, exp, chan, res, f)
-            except Exception:
-                data_partial = np.zeros(self.block_size, dtype="uint8")
-
-            data_partial[
-                i[0][0] : i[0][1], i[1][0] : i[1][1], i[2][0] : i[2][1]
-            ] = data[
-                (f[0] + i[0][0]) - xs[0] : (f[0] + i[0][1]) - xs[0],
-                (f[1] + i[1][0]) - ys[0] : (f[1] + i[1][1]) - ys[0],
-                (f[2] + i[2][0]) - zs[0] : (f[2] + i[2][1]) - zs[0],
-            ]
-            data_partial = self.fs.store(data_partial, col, exp, chan, res, f)
+                window = data_partial[
+                    i[0][0] : i[0][1], i[1][0] : i[1][1], i[2][0] : i[2][1]
+                ]
+                if block_mask is None:
+                    window[...] = block_data
+                else:
+                    np.copyto(window, block_data, where=block_mask)
+                self._store_block(data_partial, col, exp, chan, res, f)
+
+    def _store_block(
+        self,
+        data: np.array,
+        col: str,
+        exp: str,
+        chan: str,
+        res: int,
+        f: Tuple[int, int, int],
+    ):
+        """
+        Store a whole block, or only its value if it is constant.
+
+        Must be called with the block's lock held.
+        """
+        if self.sparse:
+            value = constant_value(data)
+            if value is not None:
+                self.fs.store_constant(value, col, exp, chan, res, f)
+                return
+        self.fs.store(data, col, exp, chan, res, f)
 
     def getdata(
         self,
@@ -234,43 +319,218 @@ class ChunkedFilesystemStorageManager(StorageManager):
             bossURI
 
         """
-        files = file_compute(
-            xs[0], xs[1], ys[0], ys[1], zs[0], zs[1], block_size=self.block_size
-        )
-
-        indices = blockfile_indices(xs, ys, zs, block_size=self.block_size)
+        if self._prefetcher is not None:
+            self._prefetcher.observe(col, exp, chan, res, xs, ys, zs)
+
+        plan = block_plan(xs, ys, zs, block_size=self.block_size)
+        # Pick up blocks that other processes have stored, or made constant,
+        # since the last read:
+        self.fs.refresh(col, exp, chan, res)
+
+        blocks = []
+        constants = []
+        for f, i, p in plan.blocks():
+            value = self.fs.constant(col, exp, chan, res, f)
+            if value is not None:
+                constants.append((p, value))
+            elif self.fs.hasfile(col, exp, chan, res, f):
+                blocks.append((f, i, p, True))
+            elif not self.is_terminal:
+                # we can cascade to a downstream, one block at a time:
+                blocks.append((f, i, p, False))
+            # Otherwise this is a terminal; must return something, so leave
+            # the zeros that the payload was allocated with.
+
+        def _read_block(block):
+            f, i, _, is_local = block
+            if is_local:
+                return self.fs.retrieve(col, exp, chan, res, f, window=i)
+            return self._fetch_block(col, exp, chan, res, f, i)
+
+        first = None
+        dtype = self.fs.get_dtype(col, exp, chan)
+        remote = [block for block in blocks if not block[3]]
+        if dtype is None and remote:
+            # Nothing is known about this channel locally, so the first block
+            # from the next layer decides the datatype:
+            first = remote[0]
+            blocks.remove(first)
+            first_data = _read_block(first)
+            dtype = first_data.dtype
 
         payload = np.zeros(
-            ((xs[1] - xs[0]), (ys[1] - ys[0]), (zs[1] - zs[0])), dtype="uint8"
+            ((xs[1] - xs[0]), (ys[1] - ys[0]), (zs[1] - zs[0])),
+            dtype=dtype or DEFAULT_DTYPE,
         )
+        if first is not None:
+            p = first[2]
+            payload[
+                p[0][0] : p[0][1], p[1][0] : p[1][1], p[2][0] : p[2][1]
+            ] = first_data
+        for p, value in constants:
+            # The payload is already zero, which covers most constant blocks:
+            if value:
+                payload[p[0][0] : p[0][1], p[1][0] : p[1][1], p[2][0] : p[2][1]] = value
+
+        def _scatter_block(block):
+            p = block[2]
+            # Each block lands in a disjoint region of the payload, so the
+            # blocks may be written concurrently without a lock.
+            payload[
+                p[0][0] : p[0][1], p[1][0] : p[1][1], p[2][0] : p[2][1]
+            ] = _read_block(block)
+
+        if self._pool is None or len(blocks) < 2:
+            for block in blocks:
+                _scatter_block(block)
+        else:
+            bounded_map(self._pool, _scatter_block, blocks, self.max_inflight)
+
+        return payload
 
-        for f, i in zip(files, indices):
-            print(f)
+    def _fetch_block(
+        self,
+        col: str,
+        exp: str,
+        chan: str,
+        res: int,
+        f: Tuple[int, int, int],
+        i: List[Tuple[int, int]],
+    ):
+        """
+        Get a block that is missing locally from the next layer.
+
+        The whole block is requested so that it can be stored and served
+        locally next time. Concurrent requests for the same block share a
+        single fetch. Blocks that run past the edge of the dataset are
+        fetched up to the edge and padded with zeros. If the next layer still
+        can't provide the block (e.g. because it doesn't know the extent),
+        only the window `i` is requested, and nothing is stored.
+
+        Arguments:
+            bossURI
+            f: The origin of the block
+            i: The block-local (start, stop) bounds that are needed
+
+        Returns:
+            np.array: The window `i` of the block
+
+        """
+        block = self._fetch_shared(col, exp, chan, res, f)
+        if block is None:
+            return self._next.getdata(
+                col,
+                exp,
+                chan,
+                res,
+                (f[0] + i[0][0], f[0] + i[0][1]),
+                (f[1] + i[1][0], f[1] + i[1][1]),
+                (f[2] + i[2][0], f[2] + i[2][1]),
+            )
+        return block[i[0][0] : i[0][1], i[1][0] : i[1][1], i[2][0] : i[2][1]]
+
+    def _fetch_shared(
+        self, col: str, exp: str, chan: str, res: int, f: Tuple[int, int, int]
+    ):
+        """
+        Fetch a whole block, or wait for a fetch of it that is under way.
+
+        Returns:
+            np.array: The block, or None if the next layer can't provide it
+
+        """
+        key = (col, exp, chan, res, tuple(f))
+        with self._inflight_lock:
+            future = self._inflight.get(key)
+            leader = future is None
+            if leader:
+                future = self._inflight[key] = Future()
+        if leader:
+            try:
+                future.set_result(self._fetch_whole_block(col, exp, chan, res, f))
+            except BaseException as e:
+                future.set_exception(e)
+            finally:
+                with self._inflight_lock:
+                    del self._inflight[key]
+        return future.result()
+
+    def _fetch_whole_block(
+        self, col: str, exp: str, chan: str, res: int, f: Tuple[int, int, int]
+    ):
+        """
+        Get a whole block from the next layer, and store it if caching.
+
+        The block's lock is held throughout, so when other processes miss the
+        same block at the same time, only the first fetches it, and the rest
+        read what it stored.
+
+        Returns:
+            np.array: The block, or None if the next layer can't provide it
+
+        """
+        if not self._cache:
+            return self._get_next_block(col, exp, chan, res, f)
+        with self._locks.lock(col, exp, chan, res, f):
+            self.fs.refresh(col, exp, chan, res)
             if self.fs.hasfile(col, exp, chan, res, f):
-                data_partial = self.fs.retrieve(col, exp, chan, res, f)[
-                    i[0][0] : i[0][1], i[1][0] : i[1][1], i[2][0] : i[2][1]
-                ]
-            else:
-                # what to do if the file doesn't exist
-                if self.is_terminal:
-                    # this is a terminal; must return something, so return 0s
-                    data_partial = np.zeros(self.block_size, dtype="uint8")[
-                        i[0][0] : i[0][1], i[1][0] : i[1][1], i[2][0] : i[2][1]
-                    ]
-                else:
-                    # we can cascade to a downstream:
-                    # TODO: Should just fetch the data-partial instead of
-                    # aborting the whole download and getting it from a
-                    # remote.
-                    return self._next.getdata(col, exp, chan, res, xs, ys, zs)
+                value = self.fs.constant(col, exp, chan, res, f)
+                if value is None:
+                    return self.fs.retrieve(col, exp, chan, res, f)
+                return np.full(
+                    self.block_size, value, dtype=self.fs.get_dtype(col, exp, chan)
+                )
+            block = self._get_next_block(col, exp, chan, res, f)
+            if block is None:
+                return None
+            if self.fs.get_dtype(col, exp, chan) is None:
+                self.fs.set_dtype(col, exp, chan, block.dtype)
+            self._store_block(block, col, exp, chan, res, f)
+            return block
+
+    def _get_next_block(
+        self, col: str, exp: str, chan: str, res: int, f: Tuple[int, int, int]
+    ):
+        """
+        Get a whole block from the next layer, padded past the dataset's edge.
 
-            payload[
-                (f[0] + i[0][0]) - xs[0] : (f[0] + i[0][1]) - xs[0],
-                (f[1] + i[1][0]) - ys[0] : (f[1] + i[1][1]) - ys[0],
-                (f[2] + i[2][0]) - zs[0] : (f[2] + i[2][1]) - zs[0],
-            ] = data_partial
+        Returns:
+            np.array: The block, or None if the next layer can't provide it
 
-        return payload
+        """
+        return fetch_block(
+            self._next,
+            col,
+            exp,
+            chan,
+            res,
+            f,
+            self.block_size,
+            dtype=self.fs.get_dtype(col, exp, chan),
+        )
+
+    def get_dtype(self, col: str, exp: str, chan: str) -> Optional[str]:
+        """
+        Get the datatype of a channel, from disk or from the next layer.
+
+        Arguments:
+            col, exp, chan
+
+        Returns:
+            str: The numpy name of the datatype, or None if unknown
+
+        """
+        dtype = self.fs.get_dtype(col, exp, chan)
+        if dtype is None and not self.is_terminal:
+            return self._next.get_dtype(col, exp, chan)
+        return dtype
+
+    def get_extent(
+        self, col: str, exp: str, chan: str, res: int
+    ) -> Optional[List[Tuple[int, int]]]:
+        if self.is_terminal:
+            return None
+        return self._next.get_extent(col, exp, chan, res)
 
     def __str__(self):
         return f"<ChunkedFilesystemStorageManager [{str(self.fs)}]>"
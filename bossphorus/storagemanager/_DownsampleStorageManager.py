@@ -0,0 +1,373 @@
+"""
+Copyright 2018 The Johns Hopkins University Applied Physics Laboratory.
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Optional, Set, Tuple
+import logging
+import threading
+
+import numpy as np
+
+from .StorageManager import StorageManager
+from .utils import block_plan, bounded_map
+
+log = logging.getLogger(__name__)
+
+
+def downsample_mean(data: np.ndarray, factor: Tuple[int, int, int]) -> np.ndarray:
+    """
+    Shrink a volume by averaging each `factor`-sized group of voxels.
+
+    Arguments:
+        data: An XYZ volume, a whole number of groups along each axis
+        factor: The size of a group
+
+    Returns:
+        np.ndarray: The volume, with the same dtype
+
+    """
+    (fx, fy, fz), (X, Y, Z) = factor, data.shape
+    groups = data.reshape(X // fx, fx, Y // fy, fy, Z // fz, fz)
+    mean = groups.mean(axis=(1, 3, 5))
+    if np.issubdtype(data.dtype, np.integer):
+        mean = np.rint(mean)
+    return mean.astype(data.dtype)
+
+
+def downsample_mode(data: np.ndarray, factor: Tuple[int, int, int]) -> np.ndarray:
+    """
+    Shrink a volume to the most common value of each `factor`-sized group.
+
+    Zero is taken to be background, so it only wins in a group that has
+    nothing else. Ties go to the value that comes first in the group.
+
+    Arguments:
+        data: An XYZ volume, a whole number of groups along each axis
+        factor: The size of a group
+
+    Returns:
+        np.ndarray: The volume, with the same dtype
+
+    """
+    (fx, fy, fz), (X, Y, Z) = factor, data.shape
+    groups = data.reshape(X // fx, fx, Y // fy, fy, Z // fz, fz)
+    groups = groups.transpose(0, 2, 4, 1, 3, 5).reshape(-1, fx * fy * fz)
+    # Groups are small (8 voxels for 2x2x2), so comparing every pair of
+    # voxels is cheaper than sorting:
+    counts = (groups[:, :, None] == groups[:, None, :]).sum(axis=2)
+    counts[groups == 0] = 0
+    winners = counts.argmax(axis=1)
+    mode = groups[np.arange(len(groups)), winners]
+    return mode.reshape(X // fx, Y // fy, Z // fz)
+
+
+class DownsampleStorageManager(StorageManager):
+    """
+    Builds lower resolutions of the data written to resolution 0.
+
+    Resolution r is the data of resolution r - 1, shrunk by `factor` along
+    each axis: averaged for images, and the most common label for
+    annotations (uint64 channels). Every write to resolution 0 marks the
+    blocks above it, at each level, as out of date. A background thread
+    rebuilds them once writes have been quiet for `delay` seconds, a level at
+    a time and many blocks at once, by reading from and writing to the next
+    layer. Only the blocks that uploads have touched are rebuilt.
+
+    This layer must be above any caches or buffers, so that they see the
+    levels that it writes.
+    """
+
+    def __init__(self, block_size: Tuple[int, int, int], **kwargs) -> None:
+        """
+        Create a new DownsampleStorageManager.
+
+        Arguments:
+            block_size: The size of each block that is built. This should
+                match the block size of the next layer.
+            next_layer (StorageManager): The manager to read and write
+            levels (int: 5): The number of resolutions to build above 0
+            factor (Tuple[int, int, int]: (2, 2, 1)): How much each level
+                shrinks along each axis
+            method (str: None): "mean" or "mode". By default, "mode" is used
+                for uint64 channels and "mean" for all others.
+            workers (int: 4): Number of blocks to build at once
+            delay (float: 2.0): How long, in seconds, writes must be quiet
+                before building starts
+        """
+        self.name = "DownsampleStorageManager"
+        if "next_layer" not in kwargs:
+            raise ValueError("DownsampleStorageManager requires a next_layer.")
+        self._next = kwargs["next_layer"]
+        self.is_terminal = False
+        self.block_size = tuple(block_size)
+        self.levels = kwargs.get("levels", 5)
+        self.factor = tuple(kwargs.get("factor", (2, 2, 1)))
+        self.method = kwargs.get("method", None)
+        if self.method not in (None, "mean", "mode"):
+            raise ValueError(f"Unknown downsample method: {self.method}")
+        if any(b % f for b, f in zip(self.block_size, self.factor)):
+            raise ValueError("block_size must be a multiple of factor.")
+        self.workers = kwargs.get("workers", 4)
+        self.delay = kwargs.get("delay", 2.0)
+
+        # Out-of-date blocks of level 1, by channel. Levels above are found
+        # from these as each level is built:
+        self._dirty = {}
+        self._building = set()
+        self._built = set()
+        self._dtypes = {}
+        self._changed = threading.Condition(threading.Lock())
+        # One build at a time, whether in the background or from `build`:
+        self._build_lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(
+            max_workers=self.workers, thread_name_prefix="bossphorus-downsample"
+        )
+        self.blocks_built = 0
+
+        self._builder = threading.Thread(
+            target=self._build_when_quiet, name="bossphorus-downsample"
+        )
+        self._builder.daemon = True
+        self._builder.start()
+
+    def _parents(
+        self, xs: Tuple[int, int], ys: Tuple[int, int], zs: Tuple[int, int]
+    ) -> Set[Tuple[int, int, int]]:
+        """
+        Get the origins of the blocks one level up that hold a region.
+        """
+        bounds = [
+            (start // f, -(-stop // f))
+            for (start, stop), f in zip((xs, ys, zs), self.factor)
+        ]
+        plan = block_plan(*bounds, block_size=self.block_size)
+        return {tuple(f) for f in plan.origins.tolist()}
+
+    def downsample(
+        self,
+        col: str,
+        exp: str,
+        chan: str,
+        xs: Tuple[int, int],
+        ys: Tuple[int, int],
+        zs: Tuple[int, int],
+    ):
+        """
+        Queue a region of resolution 0 to be built into the levels above.
+
+        Writes through this manager do this already. Use it for data that
+        were written some other way, e.g. before this layer was added.
+
+        Arguments:
+            col, exp, chan: The channel
+            xs, ys, zs: The bounds of the region, at resolution 0
+
+        """
+        if self.levels < 1:
+            return
+        parents = self._parents(xs, ys, zs)
+        with self._changed:
+            self._dirty.setdefault((col, exp, chan), set()).update(parents)
+            self._changed.notify_all()
+
+    def _build_when_quiet(self):
+        while True:
+            with self._changed:
+                while not self._dirty:
+                    self._changed.wait()
+                # Wait out a burst of uploads, so that a block is built once
+                # rather than once per upload into it:
+                while self._changed.wait(self.delay):
+                    pass
+            try:
+                self.build()
+            except Exception:
+                log.exception("Failed to build lower resolutions")
+
+    def build(self):
+        """
+        Build every queued block now, and wait for it to finish.
+
+        Arguments:
+            None
+
+        """
+        with self._build_lock:
+            while True:
+                with self._changed:
+                    if not self._dirty:
+                        return
+                    key = next(iter(self._dirty))
+                    dirty = self._dirty.pop(key)
+                    self._building.add(key)
+                try:
+                    self._build_channel(key, dirty)
+                except Exception:
+                    # Try again next time:
+                    with self._changed:
+                        self._dirty.setdefault(key, set()).update(dirty)
+                    raise
+                finally:
+                    with self._changed:
+                        self._building.discard(key)
+                with self._changed:
+                    self._built.add(key)
+
+    def _build_channel(self, key, dirty: Set[Tuple[int, int, int]]):
+        col, exp, chan = key
+        method = self.method
+        if method is None:
+            dtype = self.get_dtype(col, exp, chan)
+            method = "mode" if dtype == "uint64" else "mean"
+        reduce = downsample_mode if method == "mode" else downsample_mean
+
+        for level in range(1, self.levels + 1):
+            log.debug(
+                "Building %d blocks of %s/%s/%s at resolution %d",
+                len(dirty),
+                col,
+                exp,
+                chan,
+                level,
+            )
+
+            def build_block(g, level=level):
+                source = [
+                    (o * f, (o + size) * f)
+                    for o, size, f in zip(g, self.block_size, self.factor)
+                ]
+                data = self._next.getdata(col, exp, chan, str(level - 1), *source)
+                xs, ys, zs = [(o, o + size) for o, size in zip(g, self.block_size)]
+                self._next.setdata(
+                    reduce(np.asarray(data), self.factor),
+                    col,
+                    exp,
+                    chan,
+                    str(level),
+                    xs,
+                    ys,
+                    zs,
+                )
+
+            bounded_map(self._executor, build_block, sorted(dirty), self.workers * 2)
+            self.blocks_built += len(dirty)
+            if level < self.levels:
+                parents = set()
+                for g in dirty:
+                    parents |= self._parents(
+                        *[(o, o + size) for o, size in zip(g, self.block_size)]
+                    )
+                dirty = parents
+
+    def setdata(
+        self,
+        data: np.array,
+        col: str,
+        exp: str,
+        chan: str,
+        res: int,
+        xs: Tuple[int, int],
+        ys: Tuple[int, int],
+        zs: Tuple[int, int],
+    ):
+        """
+        Write the data to the next layer, and queue the levels above.
+
+        Arguments:
+            bossURI
+        """
+        self._dtypes[(col, exp, chan)] = data.dtype.name
+        self._next.setdata(data, col, exp, chan, res, xs, ys, zs)
+        if int(res) == 0:
+            self.downsample(col, exp, chan, xs, ys, zs)
+
+    def setdata_masked(
+        self,
+        data: np.array,
+        mask: np.array,
+        col: str,
+        exp: str,
+        chan: str,
+        res: int,
+        xs: Tuple[int, int],
+        ys: Tuple[int, int],
+        zs: Tuple[int, int],
+    ):
+        self._dtypes[(col, exp, chan)] = data.dtype.name
+        self._next.setdata_masked(data, mask, col, exp, chan, res, xs, ys, zs)
+        if int(res) == 0:
+            self.downsample(col, exp, chan, xs, ys, zs)
+
+    def getdata(
+        self,
+        col: str,
+        exp: str,
+        chan: str,
+        res: int,
+        xs: Tuple[int, int],
+        ys: Tuple[int, int],
+        zs: Tuple[int, int],
+    ):
+        return self._next.getdata(col, exp, chan, res, xs, ys, zs)
+
+    def hasdata(
+        self,
+        col: str,
+        exp: str,
+        chan: str,
+        res: int,
+        xs: Tuple[int, int],
+        ys: Tuple[int, int],
+        zs: Tuple[int, int],
+    ):
+        return self._next.hasdata(col, exp, chan, res, xs, ys, zs)
+
+    def get_dtype(self, col: str, exp: str, chan: str) -> Optional[str]:
+        dtype = self._dtypes.get((col, exp, chan))
+        if dtype is None:
+            dtype = self._next.get_dtype(col, exp, chan)
+        return dtype
+
+    def get_downsample_status(self, col: str, exp: str, chan: str) -> str:
+        key = (col, exp, chan)
+        with self._changed:
+            if key in self._building:
+                return "IN_PROGRESS"
+            if key in self._dirty:
+                return "QUEUED"
+            if key in self._built:
+                return "DOWNSAMPLED"
+        return self._next.get_downsample_status(col, exp, chan)
+
+    def get_extent(
+        self, col: str, exp: str, chan: str, res: int
+    ) -> Optional[List[Tuple[int, int]]]:
+        return self._next.get_extent(col, exp, chan, res)
+
+    def __str__(self):
+        return f"<DownsampleStorageManager [{self.levels} levels]>"
+
+    def get_stack_names(self):
+        """
+        Get a list of the names of the storage managers that back this one.
+
+        Arguments:
+            None
+
+        Returns:
+            List[str]
+
+        """
+        return [str(self), *self._next.get_stack_names()]
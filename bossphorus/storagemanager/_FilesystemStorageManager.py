@@ -13,14 +13,21 @@ WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 See the License for the specific language governing permissions and
 limitations under the License.
 """
-from typing import Tuple, List
+from typing import Optional, Tuple, List
 from abc import ABC, abstractmethod
 
 import os
-import h5py
+import threading
+
 import numpy as np
 
 from .StorageManager import StorageManager
+from ._H5Coverage import H5Coverage
+from ._H5FilePool import H5FilePool
+
+
+# The shape of the HDF5 chunks that data are stored in:
+CHUNK_SHAPE = (128, 128, 128)
 
 
 class FileInterface(ABC):
@@ -60,13 +67,35 @@ class FileInterface(ABC):
 
 
 class H5FileInterface(FileInterface):
-    def __init__(self, storage_path: str):
+    def __init__(self, storage_path: str, max_open_files: int = 64):
+        """
+        Create a new H5FileInterface.
+
+        Arguments:
+            storage_path: Where to store the data tree
+            max_open_files (int: 64): The most files to hold open while idle
+        """
         self.storage_path = storage_path
         self.format_name = "h5"
+        self._files = H5FilePool.shared(max_open_files)
+        self._coverage_lock = threading.Lock()
 
     def __repr__(self):
         return f"<H5FileInterface>"
 
+    def _get_coverage(self, fname: str, fh) -> H5Coverage:
+        """
+        Get the coverage of a file in use.
+
+        Coverage is kept with the pooled file, and loaded again only once
+        another process has written the file.
+        """
+        cache = self._files.cache(fname)
+        with self._coverage_lock:
+            if "coverage" not in cache:
+                cache["coverage"] = H5Coverage(fh)
+            return cache["coverage"]
+
     def store(
         self,
         data: np.array,
@@ -80,34 +109,70 @@ class H5FileInterface(FileInterface):
     ):
         os.makedirs(f"{self.storage_path}/{col}/{exp}/{chan}", exist_ok=True)
         fname = f"{self.storage_path}/{col}/{exp}/{chan}/{res}.h5"
-        if os.path.exists(fname):
-            # Open in readwrite
-            with h5py.File(fname, "r+") as fh:
-                contents = fh["data"]
-                contents.resize(
-                    (
-                        max(contents.shape[0], xs[1]),
-                        max(contents.shape[1], ys[1]),
-                        max(contents.shape[2], zs[1]),
-                    )
-                )
-                contents[xs[0] : xs[1], ys[0] : ys[1], zs[0] : zs[1]] = data
-                fh["data"][...] = contents
-        else:
-            # Create a new file in write-only:
-            with h5py.File(fname, "w") as fh:
-                d = fh.create_dataset(
+        with self._files.write(fname) as fh:
+            if "data" not in fh:
+                fh.create_dataset(
                     "data",
-                    (xs[1], ys[1], zs[1]),
+                    self._grown_shape((0, 0, 0), (xs[1], ys[1], zs[1])),
                     dtype=data.dtype,
-                    chunks=(128, 128, 128),
-                )
-                m = fh.create_dataset(
-                    "mask", (xs[1], ys[1], zs[1]), dtype="b", chunks=(128, 128, 128)
+                    chunks=CHUNK_SHAPE,
+                    maxshape=(None, None, None),
                 )
-                m[:] = False
-                d[xs[0] : xs[1], ys[0] : ys[1], zs[0] : zs[1]] = data
-                m[xs[0] : xs[1], ys[0] : ys[1], zs[0] : zs[1]] = True
+            contents = self._resize(fh, (xs[1], ys[1], zs[1]))
+            # Only the chunks that the region touches are written:
+            contents[xs[0] : xs[1], ys[0] : ys[1], zs[0] : zs[1]] = data
+            self._get_coverage(fname, fh).mark(fh, xs, ys, zs)
+
+    @staticmethod
+    def _grown_shape(shape, needed) -> Tuple[int, int, int]:
+        """
+        Get the shape to grow a dataset to, so that it holds `needed`.
+
+        Axes that must grow at least double, and are rounded up to whole
+        chunks, so that a volume that is written a piece at a time is only
+        resized a few times. Chunks are only allocated once they are
+        written, so the unused space costs nothing on disk.
+        """
+        grown = []
+        for size, need, chunk in zip(shape, needed, CHUNK_SHAPE):
+            if need > size:
+                size = max(-(-need // chunk) * chunk, 2 * size)
+            grown.append(size)
+        return tuple(grown)
+
+    def _resize(self, fh, needed):
+        """
+        Make the "data" dataset of a file at least `needed` in shape.
+
+        Datasets that were written by older versions can't be resized, so
+        they are copied into a resizable one first, a slab at a time.
+
+        Returns:
+            h5py.Dataset: The dataset
+
+        """
+        contents = fh["data"]
+        shape = self._grown_shape(contents.shape, needed)
+        if shape == contents.shape:
+            return contents
+        if contents.maxshape != (None, None, None):
+            resizable = fh.create_dataset(
+                "data.resizable",
+                shape,
+                dtype=contents.dtype,
+                chunks=contents.chunks,
+                maxshape=(None, None, None),
+            )
+            step = contents.chunks[2] if contents.chunks else CHUNK_SHAPE[2]
+            for z in range(0, contents.shape[2], step):
+                resizable[
+                    : contents.shape[0], : contents.shape[1], z : z + step
+                ] = contents[:, :, z : z + step]
+            del fh["data"]
+            fh.move("data.resizable", "data")
+            return fh["data"]
+        contents.resize(shape)
+        return contents
 
     def retrieve(
         self,
@@ -120,9 +185,18 @@ class H5FileInterface(FileInterface):
         zs: Tuple[int, int],
     ):
         fname = f"{self.storage_path}/{col}/{exp}/{chan}/{res}.h5"
-        return h5py.File(fname, "r")["data"][
-            xs[0] : xs[1], ys[0] : ys[1], zs[0] : zs[1]
-        ]
+        with self._files.read(fname) as fh:
+            if fh is None:
+                raise IOError(f"Cannot find data at: {fname}")
+            contents = fh["data"]
+            data = contents[xs[0] : xs[1], ys[0] : ys[1], zs[0] : zs[1]]
+        shape = (xs[1] - xs[0], ys[1] - ys[0], zs[1] - zs[0])
+        if data.shape != shape:
+            # Past the end of the file, nothing has been written:
+            padded = np.zeros(shape, dtype=data.dtype)
+            padded[: data.shape[0], : data.shape[1], : data.shape[2]] = data
+            data = padded
+        return data
 
     def hasdata(
         self,
@@ -135,11 +209,27 @@ class H5FileInterface(FileInterface):
         zs: Tuple[int, int],
     ):
         fname = f"{self.storage_path}/{col}/{exp}/{chan}/{res}.h5"
-        if not os.path.isfile(fname):
-            return False
-        return h5py.File(fname, "r")["mask"][
-            xs[0] : xs[1], ys[0] : ys[1], zs[0] : zs[1]
-        ].all()
+        with self._files.read(fname) as fh:
+            if fh is None:
+                return False
+            return self._get_coverage(fname, fh).covers(fh, xs, ys, zs)
+
+    def get_dtype(self, col: str, exp: str, chan: str) -> Optional[str]:
+        channel_path = f"{self.storage_path}/{col}/{exp}/{chan}"
+        if not os.path.isdir(channel_path):
+            return None
+        for fname in sorted(os.listdir(channel_path)):
+            if fname.endswith(".h5"):
+                with self._files.read(f"{channel_path}/{fname}") as fh:
+                    if fh is not None:
+                        return fh["data"].dtype.name
+        return None
+
+    def close(self):
+        """
+        Close the idle HDF5 files, and their lock files.
+        """
+        self._files.close()
 
 
 class FilesystemStorageManager(StorageManager):
@@ -158,7 +248,8 @@ class FilesystemStorageManager(StorageManager):
         Arguments:
             storage_path: Where to store the data tree
             block_size: How much data should go in each file
-            preferred_format (str: npy): file format you prefer to use on disk
+            preferred_format (str: h5): file format you prefer to use on disk
+            format_options (dict): Extra arguments for the file format
         """
         self.name = "FilesystemStorageManager"
         if "next_layer" in kwargs:
@@ -171,7 +262,7 @@ class FilesystemStorageManager(StorageManager):
         self._cache = kwargs.get("cache", True)
 
         self.fs = ({"h5": H5FileInterface}.get(kwargs.get("preferred_format", "h5")))(
-            self.storage_path
+            self.storage_path, **kwargs.get("format_options", {})
         )
 
     def hasdata(
@@ -234,6 +325,29 @@ class FilesystemStorageManager(StorageManager):
             self.setdata(data, col, exp, chan, res, xs, ys, zs)
         return data
 
+    def get_dtype(self, col: str, exp: str, chan: str) -> Optional[str]:
+        """
+        Get the datatype of a channel, from disk or from the next layer.
+
+        Arguments:
+            col, exp, chan
+
+        Returns:
+            str: The numpy name of the datatype, or None if unknown
+
+        """
+        dtype = self.fs.get_dtype(col, exp, chan)
+        if dtype is None and not self.is_terminal:
+            return self._next.get_dtype(col, exp, chan)
+        return dtype
+
+    def get_extent(
+        self, col: str, exp: str, chan: str, res: int
+    ) -> Optional[List[Tuple[int, int]]]:
+        if self.is_terminal:
+            return None
+        return self._next.get_extent(col, exp, chan, res)
+
     def __str__(self):
         return f"<FilesystemStorageManager [{str(self.fs)}]>"
 
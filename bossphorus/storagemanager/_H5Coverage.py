@@ -0,0 +1,212 @@
+"""
+Copyright 2018 The Johns Hopkins University Applied Physics Laboratory.
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+from typing import Iterator, List, Tuple
+import itertools
+
+import numpy as np
+
+
+class H5Coverage:
+    """
+    Which chunks of an HDF5 "data" dataset have been written.
+
+    Coverage is a bitmap with one entry per chunk, held in memory and saved
+    in the file as the small "coverage" dataset. A chunk that has only been
+    partly written also gets a voxel mask of its own, "partial/x_y_z", which
+    is dropped once the chunk is complete. Checking a region only reads
+    from the file when it ends in such a partial chunk.
+
+    Files from before coverage was tracked have a "mask" dataset as large as
+    the data instead. They are read as they are, and converted by
+    `migrate` on their next write.
+    """
+
+    def __init__(self, fh) -> None:
+        """
+        Load the coverage of an open file.
+
+        Arguments:
+            fh (h5py.File): The file
+        """
+        data = fh["data"]
+        self.chunks = tuple(data.chunks)
+        self.legacy = "mask" in fh and "coverage" not in fh
+        if "coverage" in fh:
+            self.bits = fh["coverage"][...].astype(bool)
+            self.partial = {
+                tuple(int(v) for v in name.split("_")) for name in fh.get("partial", {})
+            }
+        else:
+            self.bits = np.zeros(self._grid(data.shape), dtype=bool)
+            self.partial = set()
+            if self.legacy:
+                self._scan_mask(fh["mask"])
+
+    def _grid(self, shape) -> Tuple[int, int, int]:
+        return tuple(-(-s // c) for s, c in zip(shape, self.chunks))
+
+    def _scan_mask(self, mask):
+        for idx in itertools.product(*(range(n) for n in self.bits.shape)):
+            chunk = mask[self._chunk_slices(idx)]
+            if chunk.all():
+                self.bits[idx] = True
+            elif chunk.any():
+                self.partial.add(idx)
+
+    def _chunk_slices(self, idx) -> Tuple[slice, slice, slice]:
+        return tuple(slice(i * c, (i + 1) * c) for i, c in zip(idx, self.chunks))
+
+    def _chunk_windows(
+        self, bounds: List[Tuple[int, int]]
+    ) -> Iterator[Tuple[Tuple[int, int, int], Tuple[slice, slice, slice], bool]]:
+        """
+        Yield each chunk that a region touches, the chunk-local window of the
+        region, and whether the window is the whole chunk.
+        """
+        ranges = [
+            range(start // c, -(-stop // c))
+            for (start, stop), c in zip(bounds, self.chunks)
+        ]
+        for idx in itertools.product(*ranges):
+            window = tuple(
+                slice(max(start - i * c, 0), min(stop - i * c, c))
+                for i, c, (start, stop) in zip(idx, self.chunks, bounds)
+            )
+            full = all(
+                w.start == 0 and w.stop == c for w, c in zip(window, self.chunks)
+            )
+            yield idx, window, full
+
+    @staticmethod
+    def _name(idx) -> str:
+        return "_".join(str(i) for i in idx)
+
+    def _partial_mask(self, fh, idx):
+        if self.legacy:
+            return fh["mask"][self._chunk_slices(idx)]
+        return fh["partial"][self._name(idx)]
+
+    def covers(self, fh, xs, ys, zs) -> bool:
+        """
+        Check whether every voxel of a region has been written.
+
+        Arguments:
+            fh (h5py.File): The file, open for reading
+            xs, ys, zs: The bounds of the region
+
+        """
+        bounds = [xs, ys, zs]
+        lo = [start // c for (start, _), c in zip(bounds, self.chunks)]
+        hi = [-(-stop // c) for (_, stop), c in zip(bounds, self.chunks)]
+        if any(h > n for h, n in zip(hi, self.bits.shape)):
+            return False
+        if self.bits[lo[0] : hi[0], lo[1] : hi[1], lo[2] : hi[2]].all():
+            return True
+        for idx, window, _ in self._chunk_windows(bounds):
+            if self.bits[idx]:
+                continue
+            if idx not in self.partial:
+                return False
+            if not np.asarray(self._partial_mask(fh, idx)[window]).all():
+                return False
+        return True
+
+    def mark(self, fh, xs, ys, zs):
+        """
+        Record that a region has been written, and save the coverage.
+
+        Arguments:
+            fh (h5py.File): The file, open for writing
+            xs, ys, zs: The bounds of the region
+
+        """
+        self.migrate(fh)
+        grid = self._grid((xs[1], ys[1], zs[1]))
+        if any(g > n for g, n in zip(grid, self.bits.shape)):
+            bits = np.zeros(
+                [max(g, n) for g, n in zip(grid, self.bits.shape)], dtype=bool
+            )
+            bits[tuple(slice(0, n) for n in self.bits.shape)] = self.bits
+            self.bits = bits
+
+        for idx, window, full in self._chunk_windows([xs, ys, zs]):
+            if self.bits[idx]:
+                continue
+            name = self._name(idx)
+            if not full:
+                if idx not in self.partial:
+                    self._create_partial(fh, name)
+                    self.partial.add(idx)
+                # Masks are only a chunk in size, so they are updated in
+                # memory and written back whole:
+                mask = fh["partial"][name][...]
+                mask[window] = True
+                full = bool(mask.all())
+                if not full:
+                    fh["partial"][name][...] = mask
+            if full:
+                self.bits[idx] = True
+                if idx in self.partial:
+                    del fh["partial"][name]
+                    self.partial.discard(idx)
+        self._save(fh)
+
+    def migrate(self, fh):
+        """
+        Replace the voxel mask of an old file with chunk coverage.
+
+        Arguments:
+            fh (h5py.File): The file, open for writing
+
+        """
+        if not self.legacy:
+            return
+        for idx in self.partial:
+            # Chunks at the far edge of the mask are cut short:
+            mask = fh["mask"][self._chunk_slices(idx)]
+            self._create_partial(fh, self._name(idx))[
+                tuple(slice(0, n) for n in mask.shape)
+            ] = mask
+        del fh["mask"]
+        self.legacy = False
+        self._save(fh)
+
+    def _create_partial(self, fh, name: str):
+        # Masks compress to almost nothing, and a whole-chunk HDF5 chunk
+        # keeps each one to a single read and write:
+        return fh.require_group("partial").create_dataset(
+            name,
+            self.chunks,
+            dtype=bool,
+            fillvalue=False,
+            chunks=self.chunks,
+            compression="gzip",
+            compression_opts=1,
+        )
+
+    def _save(self, fh):
+        if "coverage" not in fh:
+            fh.create_dataset(
+                "coverage",
+                data=self.bits.astype("u1"),
+                maxshape=(None, None, None),
+                chunks=True,
+            )
+            return
+        coverage = fh["coverage"]
+        if coverage.shape != self.bits.shape:
+            coverage.resize(self.bits.shape)
+        coverage[...] = self.bits.astype("u1")
@@ -0,0 +1,397 @@
+"""
+Copyright 2018 The Johns Hopkins University Applied Physics Laboratory.
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+from typing import Optional
+from collections import OrderedDict
+from contextlib import contextmanager
+import os
+import threading
+
+import h5py
+
+from ._BlockLocks import OFD_LOCKS, lock_range, unlock_range
+
+# Idle handles can only be kept open if HDF5's own file lock is off, since
+# otherwise they would keep other processes from writing:
+_UNLOCKED = h5py.version.version_tuple[:2] >= (3, 5)
+
+
+class _ReadWriteLock:
+    """Many readers or one writer. Waiting writers hold off new readers."""
+
+    def __init__(self) -> None:
+        self._cond = threading.Condition(threading.Lock())
+        self._readers = 0
+        self._writing = False
+        self._writers_waiting = 0
+
+    def acquire_read(self):
+        with self._cond:
+            while self._writing or self._writers_waiting:
+                self._cond.wait()
+            self._readers += 1
+
+    def release_read(self):
+        with self._cond:
+            self._readers -= 1
+            if not self._readers:
+                self._cond.notify_all()
+
+    def acquire_write(self):
+        with self._cond:
+            self._writers_waiting += 1
+            while self._writing or self._readers:
+                self._cond.wait()
+            self._writers_waiting -= 1
+            self._writing = True
+
+    def release_write(self):
+        with self._cond:
+            self._writing = False
+            self._cond.notify_all()
+
+
+class _PooledFile:
+    def __init__(self) -> None:
+        self.lock = _ReadWriteLock()
+        # Readers that find the file closed race to open it:
+        self.open_lock = threading.Lock()
+        self.fh = None
+        self.users = 0
+        # Requests in this process reading the file, and whether they hold
+        # its shared lock:
+        self.readers = 0
+        self.locked = False
+        # The state of the file when it was last seen (see `_token`), and
+        # what has been read from it since:
+        self.token = None
+        self.cache = {}
+
+
+class H5FilePool:
+    """
+    Open HDF5 files, shared between the concurrent requests of a process.
+
+    A file is opened read-only by the first request that reads it, and kept
+    open once it is idle, so later requests don't have to open it again. At
+    most `max_open_files` idle files are held open; the least recently used
+    is closed to make room. Any number of requests may read a file at once,
+    and writes wait for them to finish. Each write opens the file read-write,
+    and closes it again when it is done.
+
+    Processes take turns with a lock on a ".<name>.lock" file next to each
+    HDF5 file (see `lock_range`): shared while requests are reading the
+    file, and exclusive while one is writing it. Writers in other processes
+    wait for it, rather than failing on HDF5's own file lock, which is off.
+    Each write also counts up a generation number kept in the lock file.
+    Before reading, a process checks the generation, and the file's inode,
+    size and modification time, and reopens the file if any have changed,
+    so that it never reads stale data.
+    """
+
+    _shared = None
+    _shared_lock = threading.Lock()
+
+    @classmethod
+    def shared(cls, max_open_files: int = 64) -> "H5FilePool":
+        """
+        Get the pool shared by everything in this process.
+
+        HDF5 won't open a file read-write in a process that has it open
+        read-only, so every user of a file must share one pool. It holds as
+        many idle files as the largest `max_open_files` that it is asked for.
+
+        Arguments:
+            max_open_files (int: 64): The most files to hold open while idle
+
+        """
+        with cls._shared_lock:
+            if cls._shared is None:
+                cls._shared = cls(max_open_files)
+            elif _UNLOCKED:
+                cls._shared.max_open_files = max(
+                    cls._shared.max_open_files, max_open_files
+                )
+            return cls._shared
+
+    @classmethod
+    def _after_fork(cls):
+        """
+        Close the files that a forked process inherited from its parent.
+        """
+        pool, cls._shared = cls._shared, None
+        cls._shared_lock = threading.Lock()
+        if pool is None:
+            return
+        for pooled in pool._files.values():
+            if pooled.fh is not None:
+                pooled.fh.close()
+        for fd in pool._lock_fds.values():
+            os.close(fd)
+
+    def __init__(self, max_open_files: int = 64) -> None:
+        """
+        Create a new H5FilePool.
+
+        Arguments:
+            max_open_files (int: 64): The most files to hold open while idle
+        """
+        self.max_open_files = max_open_files if _UNLOCKED else 0
+        self._files = OrderedDict()
+        self._lock_fds = {}
+        self._lock = threading.Lock()
+        self._fds_lock = threading.Lock()
+
+    def _checkout(self, fname: str) -> _PooledFile:
+        with self._lock:
+            pooled = self._files.get(fname)
+            if pooled is None:
+                pooled = self._files[fname] = _PooledFile()
+            self._files.move_to_end(fname)
+            pooled.users += 1
+            return pooled
+
+    def _checkin(self, fname: str, pooled: _PooledFile):
+        with self._lock:
+            pooled.users -= 1
+            if not pooled.users and pooled.token is None:
+                # Nothing to keep (e.g. the file didn't exist):
+                self._forget(fname, pooled)
+            self._evict()
+
+    def _evict(self):
+        """
+        Close idle files, oldest first, until few enough are kept.
+
+        Must be called with the lock held.
+        """
+        excess = len(self._files) - self.max_open_files
+        for fname, pooled in list(self._files.items()):
+            if excess <= 0:
+                break
+            if pooled.users:
+                continue
+            if pooled.fh is not None:
+                pooled.fh.close()
+                pooled.fh = None
+            excess -= 1
+            self._forget(fname, pooled)
+
+    def _forget(self, fname: str, pooled: _PooledFile):
+        """
+        Drop an idle file from the pool. Must be called with the lock held.
+        """
+        if self._files.get(fname) is pooled:
+            del self._files[fname]
+        if OFD_LOCKS:
+            # Without OFD locks, closing any descriptor of the lock file
+            # would drop the locks of other pools in this process on it:
+            with self._fds_lock:
+                fd = self._lock_fds.pop(fname, None)
+            if fd is not None:
+                os.close(fd)
+
+    def _lock_fd(self, fname: str) -> int:
+        with self._fds_lock:
+            if fname not in self._lock_fds:
+                directory, name = os.path.split(fname)
+                self._lock_fds[fname] = os.open(
+                    os.path.join(directory, ".{}.lock".format(name)),
+                    os.O_RDWR | os.O_CREAT,
+                    0o644,
+                )
+            return self._lock_fds[fname]
+
+    @staticmethod
+    def _generation(fd: int) -> int:
+        return int.from_bytes(os.pread(fd, 8, 0), "little")
+
+    def _token(self, fname: str, fd: Optional[int]):
+        """
+        Get the state of a file, which changes whenever it is written.
+
+        Must be called with the file locked. Returns None if it doesn't exist.
+        """
+        try:
+            stat = os.stat(fname)
+        except FileNotFoundError:
+            return None
+        if fd is None:
+            return None
+        return (self._generation(fd), stat.st_ino, stat.st_size, stat.st_mtime_ns)
+
+    @staticmethod
+    def _open(fname: str, mode: str):
+        if _UNLOCKED:
+            return h5py.File(fname, mode, locking=False)
+        return h5py.File(fname, mode)
+
+    def _refresh(self, fname: str, pooled: _PooledFile, fd: Optional[int]):
+        """
+        Close a file, and drop what was read from it, if it has changed since
+        it was last seen. Must be called with the file locked.
+        """
+        token = self._token(fname, fd)
+        if token != pooled.token:
+            if pooled.fh is not None:
+                pooled.fh.close()
+                pooled.fh = None
+            pooled.cache.clear()
+            pooled.token = token
+
+    def cache(self, fname: str) -> dict:
+        """
+        Get somewhere to keep what has been read from a file in use.
+
+        It is emptied whenever the file is written by another process, and
+        when a write in this one fails.
+
+        Arguments:
+            fname (str): A file that is being read or written
+
+        """
+        with self._lock:
+            return self._files[fname].cache
+
+    def _start_reading(self, fname: str, pooled: _PooledFile):
+        """
+        Lock a file for the requests in this process that read it, and make
+        sure it is open and up to date.
+        """
+        if not os.path.isfile(fname):
+            # There's nothing to lock (nor, maybe, a directory for the lock):
+            self._refresh(fname, pooled, None)
+            return
+        fd = self._lock_fd(fname)
+        lock_range(fd, False)
+        try:
+            self._refresh(fname, pooled, fd)
+            if pooled.fh is None and pooled.token is not None:
+                pooled.fh = self._open(fname, "r")
+        except Exception:
+            unlock_range(fd)
+            raise
+        pooled.locked = True
+
+    def _stop_reading(self, fname: str, pooled: _PooledFile):
+        if not pooled.locked:
+            return
+        if not _UNLOCKED and pooled.fh is not None:
+            # HDF5's own lock would keep other processes from writing the
+            # file while it is idle:
+            pooled.fh.close()
+            pooled.fh = None
+        unlock_range(self._lock_fd(fname))
+        pooled.locked = False
+
+    @contextmanager
+    def read(self, fname: str):
+        """
+        Use a file for reading.
+
+        Yields:
+            h5py.File: The open file, or None if it doesn't exist
+
+        """
+        pooled = self._checkout(fname)
+        pooled.lock.acquire_read()
+        try:
+            with pooled.open_lock:
+                if not pooled.readers:
+                    self._start_reading(fname, pooled)
+                pooled.readers += 1
+            try:
+                yield pooled.fh
+            finally:
+                with pooled.open_lock:
+                    pooled.readers -= 1
+                    if not pooled.readers:
+                        self._stop_reading(fname, pooled)
+        finally:
+            pooled.lock.release_read()
+            self._checkin(fname, pooled)
+
+    @contextmanager
+    def write(self, fname: str):
+        """
+        Use a file for writing, creating it if needed.
+
+        No other request can use the file until the write has finished, and
+        the file is flushed and closed afterwards.
+
+        Yields:
+            h5py.File: The open file
+
+        """
+        pooled = self._checkout(fname)
+        pooled.lock.acquire_write()
+        try:
+            fd = self._lock_fd(fname)
+            lock_range(fd, True)
+            try:
+                self._refresh(fname, pooled, fd)
+                if pooled.fh is not None:
+                    # HDF5 won't open a file read-write while it is open
+                    # read-only:
+                    pooled.fh.close()
+                    pooled.fh = None
+                fh = self._open(fname, "a")
+                try:
+                    yield fh
+                    fh.flush()
+                except Exception:
+                    pooled.cache.clear()
+                    raise
+                finally:
+                    fh.close()
+                    os.pwrite(
+                        fd, (self._generation(fd) + 1).to_bytes(8, "little"), 0
+                    )
+                    pooled.token = self._token(fname, fd)
+            finally:
+                unlock_range(fd)
+        finally:
+            pooled.lock.release_write()
+            self._checkin(fname, pooled)
+
+    def close(self):
+        """
+        Close every idle file.
+
+        Arguments:
+            None
+
+        """
+        with self._lock:
+            for fname, pooled in list(self._files.items()):
+                if pooled.users:
+                    continue
+                if pooled.fh is not None:
+                    pooled.fh.close()
+                    pooled.fh = None
+                self._forget(fname, pooled)
+            if not self._files:
+                with self._fds_lock:
+                    for fd in self._lock_fds.values():
+                        os.close(fd)
+                    self._lock_fds.clear()
+
+    def __len__(self):
+        with self._lock:
+            return sum(1 for p in self._files.values() if p.fh is not None)
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=H5FilePool._after_fork)
@@ -0,0 +1,373 @@
+"""
+Copyright 2018 The Johns Hopkins University Applied Physics Laboratory.
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Optional, Tuple
+import threading
+import time
+
+import numpy as np
+
+from .StorageManager import StorageManager
+from .utils import block_plan, bounded_map, fetch_block
+
+
+class MemoryCacheStorageManager(StorageManager):
+    """
+    An in-memory, block-aligned LRU cache in front of another StorageManager.
+
+    Reads are split into blocks of `block_size`. Each block is kept in RAM
+    once it has been read, keyed by (col, exp, chan, res, block origin), so
+    overlapping cutouts share entries. The least recently used blocks are
+    evicted once the cache holds more than `max_bytes`. Blocks that miss are
+    fetched from the next layer `workers` at a time. Blocks at the edge of
+    the dataset are fetched up to the edge and padded with zeros.
+
+    Writes go straight through to the next layer, and any cached blocks that
+    they touch are dropped. Each process keeps a cache of its own, which
+    doesn't see writes made by other processes. When other processes write
+    to the same data, pass `ttl` to bound how long a block may be served out
+    of date.
+    """
+
+    def __init__(self, block_size: Tuple[int, int, int], **kwargs) -> None:
+        """
+        Create a new MemoryCacheStorageManager.
+
+        Arguments:
+            block_size: The size of each cached block
+            next_layer (StorageManager): The manager to cache
+            max_bytes (int: 1 GiB): The most block data to hold in RAM
+            ttl (float: None): How long, in seconds, a block is kept. By
+                default, blocks are kept until a write or eviction drops them.
+            workers (int: 4): Number of blocks to fetch from the next layer
+                at once
+            max_inflight (int: 2 * workers): Largest number of outstanding
+                block fetches
+        """
+        self.name = "MemoryCacheStorageManager"
+        if "next_layer" not in kwargs:
+            raise ValueError("MemoryCacheStorageManager requires a next_layer.")
+        self._next = kwargs["next_layer"]
+        self.is_terminal = False
+        self.block_size = block_size
+        self.max_bytes = kwargs.get("max_bytes", 2 ** 30)
+        self.ttl = kwargs.get("ttl", None)
+        self.workers = kwargs.get("workers", 4)
+        self.max_inflight = kwargs.get("max_inflight", 2 * self.workers)
+        self._pool = (
+            ThreadPoolExecutor(
+                max_workers=self.workers, thread_name_prefix="bossphorus-memory-cache"
+            )
+            if self.workers > 1
+            else None
+        )
+
+        # Key to (block, expiry time or None):
+        self._blocks = OrderedDict()
+        # The number of fetches in flight of each block, and how many writes
+        # to it have landed since the first of them started. A block read
+        # while a write was landing is not cached:
+        self._fetching = {}
+        self._generations = {}
+        self._nbytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def _cached(self, key) -> bool:
+        """
+        Check whether a block is cached and fresh.
+
+        Must be called with the lock held.
+        """
+        entry = self._blocks.get(key)
+        if entry is None:
+            return False
+        if entry[1] is not None and time.monotonic() >= entry[1]:
+            self._drop(key)
+            return False
+        return True
+
+    def _drop(self, key):
+        """
+        Must be called with the lock held.
+        """
+        block, _ = self._blocks.pop(key)
+        self._nbytes -= block.nbytes
+
+    def _get_block(self, key):
+        with self._lock:
+            if not self._cached(key):
+                self.misses += 1
+                return None
+            self._blocks.move_to_end(key)
+            self.hits += 1
+            return self._blocks[key][0]
+
+    def _begin_fetch(self, key) -> int:
+        """
+        Note that a block is being fetched.
+
+        Returns:
+            int: The block's generation, to pass to `_end_fetch`
+
+        """
+        with self._lock:
+            self._fetching[key] = self._fetching.get(key, 0) + 1
+            return self._generations.get(key, 0)
+
+    def _end_fetch(self, key, block: Optional[np.array], generation: int):
+        """
+        Cache a fetched block, unless it has been written since `generation`.
+        """
+        if block is not None:
+            block = np.ascontiguousarray(block)
+            block.flags.writeable = False
+        with self._lock:
+            stale = self._generations.get(key, 0) != generation
+            fetching = self._fetching.pop(key) - 1
+            if fetching:
+                self._fetching[key] = fetching
+            else:
+                self._generations.pop(key, None)
+            if block is None or stale or block.nbytes > self.max_bytes:
+                return
+            if key in self._blocks:
+                self._drop(key)
+            expires = None if self.ttl is None else time.monotonic() + self.ttl
+            self._blocks[key] = (block, expires)
+            self._nbytes += block.nbytes
+            while self._nbytes > self.max_bytes:
+                self._drop(next(iter(self._blocks)))
+
+    def _fetch_block(
+        self,
+        col: str,
+        exp: str,
+        chan: str,
+        res: int,
+        f: Tuple[int, int, int],
+        i: List[Tuple[int, int]],
+    ):
+        """
+        Get a block from the next layer and cache it.
+
+        If the next layer refuses the whole block as out of bounds (e.g.
+        because it doesn't know the extent of the dataset), only the window
+        `i` is requested, and nothing is cached.
+
+        Returns:
+            np.array: The window `i` of the block
+
+        """
+        key = (col, exp, chan, res, tuple(f))
+        generation = self._begin_fetch(key)
+        block = None
+        try:
+            block = fetch_block(self._next, col, exp, chan, res, f, self.block_size)
+        finally:
+            self._end_fetch(key, block, generation)
+        if block is None:
+            return self._next.getdata(
+                col,
+                exp,
+                chan,
+                res,
+                (f[0] + i[0][0], f[0] + i[0][1]),
+                (f[1] + i[1][0], f[1] + i[1][1]),
+                (f[2] + i[2][0], f[2] + i[2][1]),
+            )
+        return block[i[0][0] : i[0][1], i[1][0] : i[1][1], i[2][0] : i[2][1]]
+
+    def hasdata(
+        self,
+        col: str,
+        exp: str,
+        chan: str,
+        res: int,
+        xs: Tuple[int, int],
+        ys: Tuple[int, int],
+        zs: Tuple[int, int],
+    ):
+        files = block_plan(xs, ys, zs, block_size=self.block_size).origins.tolist()
+        with self._lock:
+            if all(self._cached((col, exp, chan, res, tuple(f))) for f in files):
+                return True
+        return self._next.hasdata(col, exp, chan, res, xs, ys, zs)
+
+    def setdata(
+        self,
+        data: np.array,
+        col: str,
+        exp: str,
+        chan: str,
+        res: int,
+        xs: Tuple[int, int],
+        ys: Tuple[int, int],
+        zs: Tuple[int, int],
+    ):
+        """
+        Upload the data to the next layer, and drop stale cached blocks.
+
+        Arguments:
+            bossURI
+        """
+        self._next.setdata(data, col, exp, chan, res, xs, ys, zs)
+        self.invalidate(col, exp, chan, res, xs, ys, zs)
+
+    def setdata_masked(
+        self,
+        data: np.array,
+        mask: np.array,
+        col: str,
+        exp: str,
+        chan: str,
+        res: int,
+        xs: Tuple[int, int],
+        ys: Tuple[int, int],
+        zs: Tuple[int, int],
+    ):
+        self._next.setdata_masked(data, mask, col, exp, chan, res, xs, ys, zs)
+        self.invalidate(col, exp, chan, res, xs, ys, zs)
+
+    def getdata(
+        self,
+        col: str,
+        exp: str,
+        chan: str,
+        res: int,
+        xs: Tuple[int, int],
+        ys: Tuple[int, int],
+        zs: Tuple[int, int],
+    ):
+        """
+        Get the data, from RAM where possible.
+
+        Arguments:
+            bossURI
+
+        """
+        blocks = list(block_plan(xs, ys, zs, block_size=self.block_size).blocks())
+
+        partials = []
+        misses = []
+        for n, (f, i, _) in enumerate(blocks):
+            block = self._get_block((col, exp, chan, res, f))
+            if block is None:
+                partials.append(None)
+                misses.append(n)
+            else:
+                partials.append(
+                    block[i[0][0] : i[0][1], i[1][0] : i[1][1], i[2][0] : i[2][1]]
+                )
+
+        def _fetch(n):
+            f, i, _ = blocks[n]
+            return self._fetch_block(col, exp, chan, res, f, i)
+
+        if self._pool is None or len(misses) < 2:
+            fetched = [_fetch(n) for n in misses]
+        else:
+            fetched = bounded_map(self._pool, _fetch, misses, self.max_inflight)
+        for n, data_partial in zip(misses, fetched):
+            partials[n] = data_partial
+
+        payload = None
+        for (_, _, p), data_partial in zip(blocks, partials):
+            if payload is None:
+                payload = np.empty(
+                    ((xs[1] - xs[0]), (ys[1] - ys[0]), (zs[1] - zs[0])),
+                    dtype=data_partial.dtype,
+                )
+            payload[
+                p[0][0] : p[0][1], p[1][0] : p[1][1], p[2][0] : p[2][1]
+            ] = data_partial
+
+        return payload
+
+    def invalidate(
+        self,
+        col: str,
+        exp: str,
+        chan: str,
+        res: int,
+        xs: Tuple[int, int],
+        ys: Tuple[int, int],
+        zs: Tuple[int, int],
+    ):
+        """
+        Drop any cached blocks that overlap a region.
+
+        Arguments:
+            bossURI
+
+        """
+        files = block_plan(xs, ys, zs, block_size=self.block_size).origins.tolist()
+        with self._lock:
+            for f in files:
+                key = (col, exp, chan, res, tuple(f))
+                if key in self._fetching:
+                    self._generations[key] = self._generations.get(key, 0) + 1
+                if key in self._blocks:
+                    self._drop(key)
+
+    def get_dtype(self, col: str, exp: str, chan: str) -> Optional[str]:
+        return self._next.get_dtype(col, exp, chan)
+
+    def get_downsample_status(self, col: str, exp: str, chan: str) -> str:
+        return self._next.get_downsample_status(col, exp, chan)
+
+    def get_extent(
+        self, col: str, exp: str, chan: str, res: int
+    ) -> Optional[List[Tuple[int, int]]]:
+        return self._next.get_extent(col, exp, chan, res)
+
+    def cache_info(self):
+        """
+        Get the hit and miss counts and the current size of the cache.
+
+        Counts are in blocks, not requests.
+
+        Returns:
+            dict
+
+        """
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "blocks": len(self._blocks),
+                "bytes": self._nbytes,
+                "max_bytes": self.max_bytes,
+                "ttl": self.ttl,
+            }
+
+    def __str__(self):
+        return f"<MemoryCacheStorageManager [{self._nbytes}/{self.max_bytes} bytes]>"
+
+    def get_stack_names(self):
+        """
+        Get a list of the names of the storage managers that back this one.
+
+        Arguments:
+            None
+
+        Returns:
+            List[str]
+
+        """
+        return [str(self), *self._next.get_stack_names()]
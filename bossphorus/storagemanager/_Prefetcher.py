@@ -0,0 +1,183 @@
+"""
+Copyright 2018 The Johns Hopkins University Applied Physics Laboratory.
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+from typing import Callable, Tuple
+import logging
+import queue
+import threading
+
+import numpy as np
+
+from .utils import block_plan
+
+log = logging.getLogger(__name__)
+
+
+class _Stream:
+    """The recent reads of one channel and resolution."""
+
+    def __init__(self) -> None:
+        self.last = None
+        self.direction = None
+        self.generation = 0
+
+
+class Prefetcher:
+    """
+    Reads ahead of cutouts that move steadily in one direction.
+
+    Each read of a channel and resolution is compared with the one before
+    it. Once two moves in a row go the same way (e.g. scrolling up in z, or
+    panning right in x), the `depth` layers of blocks beyond the latest read
+    in that direction are queued to be fetched in the background, nearest
+    first.
+
+    The queue holds at most `max_queued` blocks, and blocks that don't fit
+    are dropped. When a stream changes direction, or stops moving, the
+    blocks still queued for it are cancelled.
+    """
+
+    def __init__(
+        self,
+        fetch: Callable,
+        is_present: Callable,
+        block_size: Tuple[int, int, int],
+        depth: int = 2,
+        workers: int = 2,
+        max_queued: int = 64,
+    ) -> None:
+        """
+        Create a new Prefetcher.
+
+        Arguments:
+            fetch: `fetch(col, exp, chan, res, origin)` fetches one block
+            is_present: `is_present(col, exp, chan, res, origin)` tells
+                whether a block is already stored, so needn't be fetched
+            block_size: The size of each block
+            depth (int: 2): How many layers of blocks to read ahead
+            workers (int: 2): Number of threads that fetch blocks
+            max_queued (int: 64): The most blocks to hold in the queue
+        """
+        self.fetch = fetch
+        self.is_present = is_present
+        self.block_size = tuple(block_size)
+        self.depth = depth
+        self._streams = {}
+        self._queued = set()
+        self._lock = threading.Lock()
+        self._queue = queue.Queue(maxsize=max_queued)
+        self.fetched = 0
+        self.cancelled = 0
+        for _ in range(workers):
+            thread = threading.Thread(target=self._work, name="bossphorus-prefetch")
+            thread.daemon = True
+            thread.start()
+
+    def observe(
+        self,
+        col: str,
+        exp: str,
+        chan: str,
+        res: int,
+        xs: Tuple[int, int],
+        ys: Tuple[int, int],
+        zs: Tuple[int, int],
+    ):
+        """
+        Record a read, and queue the blocks ahead of it if it is part of a
+        steady movement.
+
+        Arguments:
+            bossURI
+
+        """
+        box = np.array([xs, ys, zs])
+        with self._lock:
+            stream = self._streams.setdefault((col, exp, chan, res), _Stream())
+            last, stream.last = stream.last, box
+            if last is None:
+                return
+            direction = tuple(np.sign(box[:, 0] - last[:, 0]).tolist())
+            if direction != stream.direction:
+                # Whatever was queued was for a movement that has now ended:
+                stream.direction = direction
+                stream.generation += 1
+                return
+            if not any(direction):
+                return
+            generation = stream.generation
+
+        ahead = self._ahead(box, direction)
+        if ahead is None:
+            return
+        origins = block_plan(*ahead, block_size=self.block_size).origins.tolist()
+        # Nearest first, in the direction of travel:
+        origins.sort(key=lambda f: sum(d * c for d, c in zip(direction, f)))
+        for f in origins:
+            key = (col, exp, chan, res, tuple(f))
+            with self._lock:
+                if key in self._queued:
+                    continue
+            if self.is_present(*key):
+                continue
+            with self._lock:
+                if key in self._queued:
+                    continue
+                try:
+                    self._queue.put_nowait((key, generation))
+                except queue.Full:
+                    return
+                self._queued.add(key)
+
+    def _ahead(self, box, direction):
+        """
+        Get the region `depth` blocks beyond `box` in `direction`.
+        """
+        ahead = []
+        for (start, stop), d, size in zip(box.tolist(), direction, self.block_size):
+            if d > 0:
+                start, stop = stop, stop + self.depth * size
+            elif d < 0:
+                start, stop = max(start - self.depth * size, 0), start
+            if stop <= start:
+                return None
+            ahead.append((start, stop))
+        return ahead
+
+    def _work(self):
+        while True:
+            key, generation = self._queue.get()
+            try:
+                with self._lock:
+                    stream = self._streams.get(key[:4])
+                    current = stream is not None and stream.generation == generation
+                    if not current:
+                        self.cancelled += 1
+                if current and not self.is_present(*key):
+                    self.fetch(*key)
+                    with self._lock:
+                        self.fetched += 1
+            except Exception:
+                log.debug("Prefetch of %s failed", key, exc_info=True)
+            finally:
+                with self._lock:
+                    self._queued.discard(key)
+                self._queue.task_done()
+
+    def join(self):
+        """
+        Wait until every queued block has been fetched or cancelled.
+        """
+        self._queue.join()
@@ -13,18 +13,37 @@ WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 See the License for the specific language governing permissions and
 limitations under the License.
 """
-from typing import Tuple
+
+from typing import List, Optional, Tuple
+from concurrent.futures import ThreadPoolExecutor
+import inspect
+import threading
+import time
 
 import numpy as np
 
 from intern.remote.boss import BossRemote
+from requests import HTTPError
+from requests.adapters import HTTPAdapter
 
 from .StorageManager import StorageManager
+from .utils import block_plan, bounded_map
 
 
 class RelayStorageManager(StorageManager):
     """
+    Relays requests to an upstream bossDB (or Bossphorus) through `intern`.
+
+    Channel, experiment and coordinate frame resources are cached for
+    `metadata_ttl` seconds, so that each cutout is a single round trip.
+    Lookups of resources that don't exist upstream are cached too, for the
+    shorter `metadata_miss_ttl`, so that a stream of uploads to a new
+    channel doesn't ask about it every time. Call `invalidate_metadata`
+    after changing resources upstream.
 
+    Cutouts that span more than one block of `block_size` are split into
+    block-aligned sub-cutouts, which are fetched concurrently (at most
+    `max_concurrency` at once) over a shared pool of HTTP connections.
     """
 
     def __init__(self, **kwargs):
@@ -33,9 +52,24 @@ class RelayStorageManager(StorageManager):
 
         Arguments:
 
-            block_size: How much data should go in each file
+            block_size: The size of the sub-cutouts to request upstream
+            max_concurrency (int: 8): The most sub-cutouts to request at
+                once, across all requests. 1 requests them one at a time.
+            metadata_ttl (float: 300): Seconds to cache upstream resources
+            metadata_miss_ttl (float: 10): Seconds to remember that a
+                resource doesn't exist upstream
         """
         self.block_size = kwargs.get("block_size", (256, 256, 16))
+        self.metadata_ttl = kwargs.get("metadata_ttl", 300)
+        self.metadata_miss_ttl = kwargs.get("metadata_miss_ttl", 10)
+        self._metadata = {}
+        self._metadata_lock = threading.Lock()
+        self.max_concurrency = kwargs.get("max_concurrency", 8)
+        self._pool = (
+            ThreadPoolExecutor(max_workers=self.max_concurrency)
+            if self.max_concurrency > 1
+            else None
+        )
 
         if "next_layer" in kwargs:
             self._next = kwargs["next_layer"]
@@ -55,6 +89,105 @@ class RelayStorageManager(StorageManager):
                 }
             )
 
+        # Sub-cutouts are already fetched concurrently here, so intern mustn't
+        # split them again into a process pool of its own:
+        self._cutout_kwargs = {}
+        if "parallel" in inspect.signature(self.boss_remote.get_cutout).parameters:
+            self._cutout_kwargs["parallel"] = False
+        self._pool_connections()
+
+    def _pool_connections(self):
+        """
+        Let the cutout HTTP session keep a connection open per concurrent
+        sub-cutout, instead of requests' default of 10.
+        """
+        session = getattr(getattr(self.boss_remote, "_volume", None), "session", None)
+        if session is None:
+            return
+        adapter = HTTPAdapter(pool_maxsize=max(self.max_concurrency, 10))
+        session.mount("http://", adapter)
+        session.mount("https://", adapter)
+
+    def _cached(self, key, fetch):
+        """
+        Get an upstream resource from the cache, or fetch and cache it.
+
+        Exceptions from `fetch` are cached as well, and raised again until
+        they expire.
+        """
+        now = time.monotonic()
+        with self._metadata_lock:
+            entry = self._metadata.get(key)
+        if entry is None or entry[0] <= now:
+            try:
+                entry = (now + self.metadata_ttl, fetch(), None)
+            except Exception as e:
+                entry = (now + self.metadata_miss_ttl, None, e)
+            with self._metadata_lock:
+                self._metadata[key] = entry
+        if entry[2] is not None:
+            raise entry[2]
+        return entry[1]
+
+    def get_channel(self, col: str, exp: str, chan: str):
+        """
+        Get a channel resource from upstream, through the metadata cache.
+
+        Returns:
+            intern.resource.boss.ChannelResource
+
+        """
+        return self._cached(
+            ("channel", col, exp, chan),
+            lambda: self.boss_remote.get_channel(chan, col, exp),
+        )
+
+    def get_experiment(self, col: str, exp: str):
+        """
+        Get an experiment resource from upstream, through the metadata cache.
+
+        Returns:
+            intern.resource.boss.ExperimentResource
+
+        """
+        return self._cached(
+            ("experiment", col, exp),
+            lambda: self.boss_remote.get_experiment(col, exp),
+        )
+
+    def get_coordinate_frame(self, col: str, exp: str):
+        """
+        Get the coordinate frame of an experiment, through the metadata cache.
+
+        Returns:
+            intern.resource.boss.CoordinateFrameResource
+
+        """
+        return self._cached(
+            ("coord_frame", col, exp),
+            lambda: self.boss_remote.get_coordinate_frame(
+                self.get_experiment(col, exp).coord_frame
+            ),
+        )
+
+    def invalidate_metadata(self, col: str = None, exp: str = None, chan: str = None):
+        """
+        Forget cached upstream resources.
+
+        With no arguments, everything is forgotten. Otherwise only the
+        resources of the given collection, experiment or channel (and those
+        within it) are.
+
+        Arguments:
+            col, exp, chan
+
+        """
+        prefix = tuple(v for v in (col, exp, chan) if v is not None)
+        with self._metadata_lock:
+            for key in list(self._metadata):
+                if key[1 : 1 + len(prefix)] == prefix:
+                    del self._metadata[key]
+
     def hasdata(
         self,
         col: str,
@@ -65,9 +198,12 @@ class RelayStorageManager(StorageManager):
         ys: Tuple[int, int],
         zs: Tuple[int, int],
     ):
-        has_data = self.boss_remote.get_channel(f"bossdb://{col}/{exp}/{chan}")
-        if has_data:
-            return True
+        try:
+            if self.get_channel(col, exp, chan):
+                return True
+        except Exception:
+            # The channel doesn't exist upstream (or upstream is unreachable):
+            pass
 
         if not self.is_terminal:
             return self._next.hasdata(col, exp, chan, res, xs, ys, zs)
@@ -84,8 +220,14 @@ class RelayStorageManager(StorageManager):
         ys: Tuple[int, int],
         zs: Tuple[int, int],
     ):
+        # intern takes data in ZYX order:
         return self.boss_remote.create_cutout(
-            self.boss_remote.get_channel(chan, col, exp), res, xs, ys, zs, data
+            self.get_channel(col, exp, chan),
+            res,
+            xs,
+            ys,
+            zs,
+            np.ascontiguousarray(data.transpose()),
         )
 
     def getdata(
@@ -98,10 +240,93 @@ class RelayStorageManager(StorageManager):
         ys: Tuple[int, int],
         zs: Tuple[int, int],
     ) -> np.array:
-        return self.boss_remote.get_cutout(
-            self.boss_remote.get_channel(chan, col, exp), res, xs, ys, zs
+        channel = self.get_channel(col, exp, chan)
+        plan = block_plan(xs, ys, zs, block_size=self.block_size)
+        if len(plan.origins) == 1:
+            return self._get_cutout(channel, res, xs, ys, zs)
+
+        payload = np.empty(
+            ((xs[1] - xs[0]), (ys[1] - ys[0]), (zs[1] - zs[0])),
+            dtype=channel.datatype,
         )
 
+        def _fetch_block(block):
+            f, i, p = block
+            # Each block lands in a disjoint region of the payload:
+            payload[p[0][0] : p[0][1], p[1][0] : p[1][1], p[2][0] : p[2][1]] = (
+                self._get_cutout(
+                    channel,
+                    res,
+                    (f[0] + i[0][0], f[0] + i[0][1]),
+                    (f[1] + i[1][0], f[1] + i[1][1]),
+                    (f[2] + i[2][0], f[2] + i[2][1]),
+                )
+            )
+
+        if self._pool is None:
+            for block in plan.blocks():
+                _fetch_block(block)
+        else:
+            bounded_map(self._pool, _fetch_block, plan.blocks(), self.max_concurrency)
+        return payload
+
+    def _get_cutout(self, channel, res: int, xs, ys, zs) -> np.array:
+        try:
+            # intern returns data in ZYX order:
+            return self.boss_remote.get_cutout(
+                channel, res, xs, ys, zs, **self._cutout_kwargs
+            ).transpose()
+        except HTTPError as e:
+            # bossDB answers cutouts outside of the coordinate frame with a
+            # 400:
+            if e.response is not None and e.response.status_code == 400:
+                raise IndexError(
+                    "Cutout {} {} {} is out of bounds: {}".format(xs, ys, zs, e)
+                ) from e
+            raise
+
+    def get_extent(
+        self, col: str, exp: str, chan: str, res: int
+    ) -> Optional[List[Tuple[int, int]]]:
+        """
+        Get the bounds of a channel's coordinate frame at a resolution.
+
+        Arguments:
+            col, exp, chan, res
+
+        Returns:
+            List[Tuple[int, int]]: The (start, stop) bounds of x, y and z, or
+                None if upstream doesn't have the experiment
+
+        """
+        try:
+            frame = self.get_coordinate_frame(col, exp)
+            method = self.get_experiment(col, exp).hierarchy_method
+        except Exception:
+            # The experiment doesn't exist upstream (or upstream is
+            # unreachable):
+            return None
+        scale = 2 ** int(res)
+        scales = (scale, scale, scale if method == "isotropic" else 1)
+        return [
+            (start // s, -(-stop // s))
+            for (start, stop), s in zip(
+                [
+                    (frame.x_start, frame.x_stop),
+                    (frame.y_start, frame.y_stop),
+                    (frame.z_start, frame.z_stop),
+                ],
+                scales,
+            )
+        ]
+
+    def get_dtype(self, col: str, exp: str, chan: str) -> Optional[str]:
+        try:
+            return self.get_channel(col, exp, chan).datatype
+        except Exception:
+            # The channel doesn't exist upstream (or upstream is unreachable):
+            return None
+
     def __repr__(self):
         return f"<RelayStorageManager [BossRemote]>"
 
@@ -13,7 +13,7 @@ WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 See the License for the specific language governing permissions and
 limitations under the License.
 """
-from typing import List, Tuple
+from typing import List, Optional, Tuple
 
 import numpy as np
 
@@ -82,3 +82,10 @@ class SimpleCacheStorageManager(StorageManager):
             if layer.hasdata(col, exp, chan, res, xs, ys, zs):
                 return layer.getdata(col, exp, chan, res, xs, ys, zs)
         raise ValueError("Data could not be retrieved.")
+
+    def get_dtype(self, col: str, exp: str, chan: str) -> Optional[str]:
+        for layer in self.layers:
+            dtype = layer.get_dtype(col, exp, chan)
+            if dtype is not None:
+                return dtype
+        return None
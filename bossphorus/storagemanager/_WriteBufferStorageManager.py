@@ -0,0 +1,471 @@
+"""
+Copyright 2018 The Johns Hopkins University Applied Physics Laboratory.
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+from collections import OrderedDict
+from typing import List, Optional, Tuple
+import atexit
+import logging
+import threading
+import time
+
+import numpy as np
+
+from .StorageManager import StorageManager
+from .utils import block_plan
+
+log = logging.getLogger(__name__)
+
+
+class _DirtyBlock:
+    """
+    The buffered writes to one block, and which voxels they cover.
+
+    Only the bounding box of the writes is held, as data and a one-byte mask
+    per voxel, and it grows as writes land outside it. A small upload costs
+    its own size, not the whole block's.
+    """
+
+    def __init__(self, dtype) -> None:
+        self.dtype = np.dtype(dtype)
+        # The box, in block coordinates:
+        self.bounds = [(0, 0), (0, 0), (0, 0)]
+        self.data = np.empty((0, 0, 0), dtype=dtype)
+        self.mask = np.zeros((0, 0, 0), dtype=bool)
+        self.created = time.monotonic()
+
+    @property
+    def nbytes(self) -> int:
+        return self.data.nbytes + self.mask.nbytes
+
+    def _grow(self, bounds):
+        """
+        Grow the box to hold the window `bounds`.
+        """
+        if not self.mask.size:
+            grown = [tuple(b) for b in bounds]
+        else:
+            grown = [
+                (min(start, b[0]), max(stop, b[1]))
+                for (start, stop), b in zip(self.bounds, bounds)
+            ]
+        if grown == self.bounds:
+            return
+        shape = tuple(stop - start for start, stop in grown)
+        data = np.empty(shape, dtype=self.dtype)
+        mask = np.zeros(shape, dtype=bool)
+        old = self._local(self.bounds, grown)
+        data[old] = self.data
+        mask[old] = self.mask
+        self.bounds, self.data, self.mask = grown, data, mask
+
+    @staticmethod
+    def _local(bounds, box) -> Tuple[slice, slice, slice]:
+        return tuple(
+            slice(start - b[0], stop - b[0]) for (start, stop), b in zip(bounds, box)
+        )
+
+    def write(self, bounds, data: np.array, mask: np.array = None):
+        """
+        Write data into a window of the block.
+
+        Arguments:
+            bounds: The window, in block coordinates
+            data: The data to write
+            mask (np.array: None): Which voxels of `data` to write, if not all
+        """
+        self._grow(bounds)
+        window = self._local(bounds, self.bounds)
+        if mask is None:
+            self.data[window] = data
+            self.mask[window] = True
+        else:
+            np.copyto(self.data[window], data, where=mask)
+            self.mask[window] |= mask
+
+    def read(self, bounds) -> Tuple[np.array, np.array]:
+        """
+        Get the data and mask of a window of the block.
+        """
+        shape = tuple(stop - start for start, stop in bounds)
+        data = np.empty(shape, dtype=self.dtype)
+        mask = np.zeros(shape, dtype=bool)
+        overlap = [
+            (max(start, b[0]), min(stop, b[1]))
+            for (start, stop), b in zip(self.bounds, bounds)
+        ]
+        if all(start < stop for start, stop in overlap):
+            src = self._local(overlap, self.bounds)
+            dst = self._local(overlap, bounds)
+            data[dst] = self.data[src]
+            mask[dst] = self.mask[src]
+        return data, mask
+
+
+class WriteBufferStorageManager(StorageManager):
+    """
+    A write-combining buffer in front of another StorageManager.
+
+    Uploads are split into blocks of `block_size` and copied into per-block
+    buffers in RAM, along with a mask of the voxels they have written. Each
+    buffer only spans the bounding box of the writes to its block. Each
+    dirty block is written to the next layer once, with a single `setdata`,
+    when the buffer holds more than `max_bytes`, when the block has been
+    dirty for `max_age` seconds, when `flush` is called, or when the process
+    exits. Many small uploads into the same block therefore cost one
+    read-modify-write of that block in the next layer, rather than one each.
+
+    Reads go to the next layer, and the buffered voxels are laid over the
+    result, so buffered data are visible straight away. Uploads that cover
+    only whole blocks skip the buffer and go straight to the next layer.
+
+    Each process buffers on its own, so other worker processes only see
+    buffered data once it has been written. Partial blocks are merged with
+    the next layer's `setdata_masked`, which only ChunkedFilesystemStorageManager
+    makes safe against concurrent writes from other processes.
+    """
+
+    def __init__(self, block_size: Tuple[int, int, int], **kwargs) -> None:
+        """
+        Create a new WriteBufferStorageManager.
+
+        Arguments:
+            block_size: The size of each buffered block. This should match
+                the block size of the next layer.
+            next_layer (StorageManager): The manager to write to
+            max_bytes (int: 256 MiB): The most buffered data to hold in RAM,
+                counting one extra byte per voxel for the mask
+            max_age (float: 5.0): The longest time, in seconds, that a block
+                may stay dirty before it is written
+        """
+        self.name = "WriteBufferStorageManager"
+        if "next_layer" not in kwargs:
+            raise ValueError("WriteBufferStorageManager requires a next_layer.")
+        self._next = kwargs["next_layer"]
+        self.is_terminal = False
+        self.block_size = tuple(block_size)
+        self.max_bytes = kwargs.get("max_bytes", 256 * 2 ** 20)
+        self.max_age = kwargs.get("max_age", 5.0)
+
+        # Blocks waiting to be written, oldest first:
+        self._buffers = OrderedDict()
+        # Blocks that are being written to the next layer right now. They are
+        # still laid over reads until the write has finished:
+        self._flushing = {}
+        self._nbytes = 0
+        self._dtypes = {}
+        self._lock = threading.Lock()
+        # Writes of the same block to the next layer must land in order, so
+        # each block is written while holding its stripe:
+        self._stripes = [threading.Lock() for _ in range(64)]
+
+        self._closed = threading.Event()
+        self._flusher = threading.Thread(
+            target=self._flush_periodically, name="bossphorus-write-buffer"
+        )
+        self._flusher.daemon = True
+        self._flusher.start()
+        atexit.register(self.close)
+
+    def _stripe(self, key) -> int:
+        return hash(key) % len(self._stripes)
+
+    def _flush_periodically(self):
+        while not self._closed.wait(max(self.max_age / 2, 0.1)):
+            deadline = time.monotonic() - self.max_age
+            with self._lock:
+                stale = [k for k, b in self._buffers.items() if b.created <= deadline]
+            for key in stale:
+                try:
+                    self._flush_block(key)
+                except Exception:
+                    log.exception("Failed to flush buffered block %s", key)
+
+    def _flush_block(self, key):
+        """
+        Write one buffered block to the next layer.
+
+        Only the bounding box of the dirty voxels is written, with
+        `setdata_masked`, so the voxels of the box that weren't written keep
+        what the next layer holds. If the write fails, the block is buffered
+        again so that nothing is lost.
+        """
+        with self._stripes[self._stripe(key)]:
+            with self._lock:
+                block = self._buffers.pop(key, None)
+                if block is None:
+                    return
+                self._nbytes -= block.nbytes
+                self._flushing[key] = block
+            try:
+                self._write_block(key, block)
+            except Exception:
+                with self._lock:
+                    del self._flushing[key]
+                    self._restore(key, block)
+                raise
+            with self._lock:
+                del self._flushing[key]
+
+    def _write_block(self, key, block: _DirtyBlock):
+        col, exp, chan, res, f = key
+        xs, ys, zs = [
+            (f[axis] + start, f[axis] + stop)
+            for axis, (start, stop) in enumerate(block.bounds)
+        ]
+        self._next.setdata_masked(
+            block.data, block.mask, col, exp, chan, res, xs, ys, zs
+        )
+
+    def _restore(self, key, block: _DirtyBlock):
+        """
+        Put back a block that failed to flush, under any newer writes to it.
+
+        Must be called with the lock held.
+        """
+        newer = self._buffers.get(key)
+        if newer is not None:
+            nbytes = newer.nbytes
+            _, covered = newer.read(block.bounds)
+            newer.write(block.bounds, block.data, block.mask & ~covered)
+            newer.created = min(newer.created, block.created)
+            self._nbytes += newer.nbytes - nbytes
+            return
+        self._buffers[key] = block
+        self._buffers.move_to_end(key, last=False)
+        self._nbytes += block.nbytes
+
+    def flush(self):
+        """
+        Write every buffered block to the next layer.
+
+        Arguments:
+            None
+
+        """
+        with self._lock:
+            keys = list(self._buffers)
+        for key in keys:
+            self._flush_block(key)
+
+    def close(self):
+        """
+        Stop the background flusher and write every buffered block.
+
+        Arguments:
+            None
+
+        """
+        self._closed.set()
+        self.flush()
+
+    def _overlays(self, col, exp, chan, res, plan):
+        """
+        Copy the buffered windows of the blocks in a plan.
+
+        Windows that are being flushed come before those that are still
+        buffered, so that laying them over in order leaves the newest data.
+
+        Returns:
+            List of (payload window, data, mask), and whether the buffers
+            cover every voxel of the plan
+        """
+        overlays = []
+        covered = True
+        with self._lock:
+            for f, i, p in plan.blocks():
+                key = (col, exp, chan, res, f)
+                block_covered = False
+                for block in (self._flushing.get(key), self._buffers.get(key)):
+                    if block is None:
+                        continue
+                    data, mask = block.read(i)
+                    if not mask.any():
+                        continue
+                    block_covered = block_covered or bool(mask.all())
+                    overlays.append((p, data, mask))
+                covered = covered and block_covered
+        return overlays, covered
+
+    def hasdata(
+        self,
+        col: str,
+        exp: str,
+        chan: str,
+        res: int,
+        xs: Tuple[int, int],
+        ys: Tuple[int, int],
+        zs: Tuple[int, int],
+    ):
+        plan = block_plan(xs, ys, zs, block_size=self.block_size)
+        _, covered = self._overlays(col, exp, chan, res, plan)
+        return covered or self._next.hasdata(col, exp, chan, res, xs, ys, zs)
+
+    def setdata(
+        self,
+        data: np.array,
+        col: str,
+        exp: str,
+        chan: str,
+        res: int,
+        xs: Tuple[int, int],
+        ys: Tuple[int, int],
+        zs: Tuple[int, int],
+    ):
+        """
+        Buffer the data, to be written to the next layer later.
+
+        Arguments:
+            bossURI
+        """
+        dtype = self.get_dtype(col, exp, chan)
+        if dtype is not None and np.dtype(dtype) != data.dtype:
+            raise ValueError(
+                "Channel {}/{}/{} holds {} data, not {}.".format(
+                    col, exp, chan, dtype, data.dtype
+                )
+            )
+        self._dtypes[(col, exp, chan)] = data.dtype.name
+
+        plan = block_plan(xs, ys, zs, block_size=self.block_size)
+        full = [[0, size] for size in self.block_size]
+        blocks = list(plan.blocks())
+
+        if all(i == full for _, i, _ in blocks):
+            # Whole blocks gain nothing from buffering. Older buffered writes
+            # to them are overwritten, so they can be dropped:
+            keys = [(col, exp, chan, res, f) for f, _, _ in blocks]
+            stripes = sorted({self._stripe(key) for key in keys})
+            for stripe in stripes:
+                self._stripes[stripe].acquire()
+            try:
+                with self._lock:
+                    for key in keys:
+                        block = self._buffers.pop(key, None)
+                        if block is not None:
+                            self._nbytes -= block.nbytes
+                self._next.setdata(data, col, exp, chan, res, xs, ys, zs)
+            finally:
+                for stripe in stripes:
+                    self._stripes[stripe].release()
+            return
+
+        with self._lock:
+            for f, i, p in blocks:
+                key = (col, exp, chan, res, f)
+                block = self._buffers.get(key)
+                if block is None:
+                    block = self._buffers[key] = _DirtyBlock(data.dtype)
+                nbytes = block.nbytes
+                block.write(
+                    i, data[p[0][0] : p[0][1], p[1][0] : p[1][1], p[2][0] : p[2][1]]
+                )
+                self._nbytes += block.nbytes - nbytes
+            overflow = []
+            excess = self._nbytes - self.max_bytes
+            for key, block in self._buffers.items():
+                if excess <= 0:
+                    break
+                overflow.append(key)
+                excess -= block.nbytes
+
+        # The buffer is full, so write out the oldest blocks in this thread.
+        # This also slows uploads down to the pace of the next layer:
+        for key in overflow:
+            self._flush_block(key)
+
+    def getdata(
+        self,
+        col: str,
+        exp: str,
+        chan: str,
+        res: int,
+        xs: Tuple[int, int],
+        ys: Tuple[int, int],
+        zs: Tuple[int, int],
+    ):
+        """
+        Get the data from the next layer, with buffered writes laid over it.
+
+        Arguments:
+            bossURI
+
+        """
+        plan = block_plan(xs, ys, zs, block_size=self.block_size)
+        # The buffers are copied before the next layer is read. A block that
+        # finishes flushing in between is then found in both, and never in
+        # neither:
+        overlays, covered = self._overlays(col, exp, chan, res, plan)
+        shape = ((xs[1] - xs[0]), (ys[1] - ys[0]), (zs[1] - zs[0]))
+        if covered:
+            payload = np.empty(shape, dtype=overlays[0][1].dtype)
+        else:
+            payload = self._next.getdata(col, exp, chan, res, xs, ys, zs)
+            if overlays and (
+                payload.dtype != overlays[0][1].dtype or not payload.flags.writeable
+            ):
+                payload = payload.astype(overlays[0][1].dtype)
+        for p, data, mask in overlays:
+            np.copyto(
+                payload[p[0][0] : p[0][1], p[1][0] : p[1][1], p[2][0] : p[2][1]],
+                data,
+                where=mask,
+            )
+        return payload
+
+    def get_dtype(self, col: str, exp: str, chan: str) -> Optional[str]:
+        dtype = self._dtypes.get((col, exp, chan))
+        if dtype is None:
+            dtype = self._next.get_dtype(col, exp, chan)
+        return dtype
+
+    def get_downsample_status(self, col: str, exp: str, chan: str) -> str:
+        return self._next.get_downsample_status(col, exp, chan)
+
+    def get_extent(
+        self, col: str, exp: str, chan: str, res: int
+    ) -> Optional[List[Tuple[int, int]]]:
+        return self._next.get_extent(col, exp, chan, res)
+
+    def buffer_info(self):
+        """
+        Get the number of dirty blocks and the size of the buffer.
+
+        Returns:
+            dict
+
+        """
+        with self._lock:
+            return {
+                "blocks": len(self._buffers),
+                "flushing": len(self._flushing),
+                "bytes": self._nbytes,
+                "max_bytes": self.max_bytes,
+            }
+
+    def __str__(self):
+        return f"<WriteBufferStorageManager [{self._nbytes}/{self.max_bytes} bytes]>"
+
+    def get_stack_names(self):
+        """
+        Get a list of the names of the storage managers that back this one.
+
+        Arguments:
+            None
+
+        Returns:
+            List[str]
+
+        """
+        return [str(self), *self._next.get_stack_names()]
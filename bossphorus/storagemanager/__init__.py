@@ -18,6 +18,9 @@ from .StorageManager import StorageManager
 from ._FilesystemStorageManager import FilesystemStorageManager
 from ._ChunkedFilesystemStorageManager import ChunkedFilesystemStorageManager
 from ._RelayStorageManager import RelayStorageManager
+from ._MemoryCacheStorageManager import MemoryCacheStorageManager
+from ._WriteBufferStorageManager import WriteBufferStorageManager
+from ._DownsampleStorageManager import DownsampleStorageManager
 
 
 def create(
@@ -13,7 +13,10 @@ WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 See the License for the specific language governing permissions and
 limitations under the License.
 """
-from typing import Tuple
+from concurrent.futures import Executor, FIRST_COMPLETED, wait
+from typing import Callable, Iterable, Iterator, List, NamedTuple, Optional, Tuple
+
+import numpy as np
 
 
 def file_compute(
@@ -101,11 +104,13 @@ def block_compute(
     for x in x_block_origins:
         for y in y_block_origins:
             for z in z_block_origins:
+                # Blocks end at the next block boundary, even when they start
+                # partway through a block:
                 files.append(
                     (
-                        (x, min(x_stop, x + block_size[0])),
-                        (y, min(y_stop, y + block_size[1])),
-                        (z, min(z_stop, z + block_size[2])),
+                        (x, min(x_stop, (x // block_size[0] + 1) * block_size[0])),
+                        (y, min(y_stop, (y // block_size[1] + 1) * block_size[1])),
+                        (z, min(z_stop, (z // block_size[2] + 1) * block_size[2])),
                     )
                 )
     return files
@@ -145,3 +150,171 @@ def blockfile_indices(
         )
 
     return inds
+
+
+class BlockPlan(NamedTuple):
+    """
+    The blocks needed for a volume, and where each one goes.
+
+    Row n of each array describes the same block:
+
+        origins[n]:         (x, y, z) origin of the block
+        block_windows[n]:   (start, stop) per axis, relative to the block
+        payload_windows[n]: (start, stop) per axis, relative to the volume
+
+    Blocks are ordered the same way as `file_compute`.
+    """
+
+    origins: np.ndarray
+    block_windows: np.ndarray
+    payload_windows: np.ndarray
+
+    def __len__(self):
+        return len(self.origins)
+
+    def blocks(
+        self
+    ) -> Iterator[Tuple[Tuple[int, int, int], List[List[int]], List[List[int]]]]:
+        """
+        Iterate over (origin, block window, payload window) as plain ints.
+
+        The origin is a tuple, so that it can be used as a key. The windows
+        are lists of three [start, stop] pairs.
+        """
+        for origin, block_window, payload_window in zip(
+            self.origins.tolist(),
+            self.block_windows.tolist(),
+            self.payload_windows.tolist(),
+        ):
+            yield tuple(origin), block_window, payload_window
+
+
+def block_plan(
+    xs: Tuple[int, int],
+    ys: Tuple[int, int],
+    zs: Tuple[int, int],
+    block_size: Tuple[int, int, int],
+) -> BlockPlan:
+    """
+    Compute the blocks that hold a volume, and the windows to copy.
+
+    This is equivalent to calling `file_compute` and `blockfile_indices`
+    together, but the block bounds along each axis are found with floor
+    division rather than by scanning every block from the origin, so the
+    cost depends only on the number of blocks returned.
+
+    Arguments:
+        xs, ys, zs: (start, stop) bounds of the volume
+        block_size: The block-size stored in each file
+
+    Returns:
+        BlockPlan
+
+    """
+    axes = []
+    for (start, stop), size in zip((xs, ys, zs), block_size):
+        origins = np.arange(start // size, -(-stop // size), dtype=np.int64) * size
+        lo = np.maximum(origins, start)
+        hi = np.minimum(origins + size, stop)
+        axes.append((origins, lo, hi, start))
+
+    flat = np.indices([len(a[0]) for a in axes]).reshape(3, -1)
+
+    origins = np.stack([a[0][n] for a, n in zip(axes, flat)], axis=1)
+    lo = np.stack([a[1][n] for a, n in zip(axes, flat)], axis=1)
+    hi = np.stack([a[2][n] for a, n in zip(axes, flat)], axis=1)
+    starts = np.array([a[3] for a in axes], dtype=np.int64)
+
+    block_windows = np.stack([lo - origins, hi - origins], axis=2)
+    payload_windows = np.stack([lo - starts, hi - starts], axis=2)
+    return BlockPlan(origins, block_windows, payload_windows)
+
+
+def bounded_map(
+    executor: Executor, fn: Callable, items: Iterable, max_inflight: int
+) -> List:
+    """
+    Run `fn` over `items` on `executor`, keeping at most `max_inflight` calls
+    submitted at any one time.
+
+    Results are returned in the same order as `items`. If any call raises,
+    no further calls are submitted and the first exception is re-raised.
+
+    Arguments:
+        executor: The pool on which to run the calls
+        fn: A single-argument callable
+        items: The arguments to pass to `fn`
+        max_inflight: The largest number of outstanding calls
+
+    Returns:
+        List: The return value of each call
+
+    """
+    results = {}
+    pending = {}
+    for n, item in enumerate(items):
+        if len(pending) >= max_inflight:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                results[pending.pop(future)] = future.result()
+        pending[executor.submit(fn, item)] = n
+    for future in wait(pending).done:
+        results[pending[future]] = future.result()
+    return [results[n] for n in range(len(results))]
+
+
+def fetch_block(
+    manager,
+    col: str,
+    exp: str,
+    chan: str,
+    res: int,
+    f: Tuple[int, int, int],
+    block_size: Tuple[int, int, int],
+    dtype: Optional[str] = None,
+) -> Optional[np.ndarray]:
+    """
+    Get a whole block from a storage manager, padded past the dataset's edge.
+
+    Only the part of the block within the manager's `get_extent` is
+    requested, and the rest is filled with zeros, so that blocks at the edge
+    of the dataset can be cached like any other.
+
+    Arguments:
+        manager (StorageManager): The manager to read from
+        col, exp, chan, res
+        f: The origin of the block
+        block_size: The size of the block
+        dtype (str: None): The datatype of a block that is wholly outside of
+            the dataset. By default, the manager's, or else uint8.
+
+    Returns:
+        np.ndarray: The block, or None if the manager refuses it as out of
+            bounds (with an IndexError)
+
+    """
+    bounds = [(o, o + size) for o, size in zip(f, block_size)]
+    extent = manager.get_extent(col, exp, chan, res)
+    if extent is not None:
+        bounds = [
+            (max(start, e_start), min(stop, e_stop))
+            for (start, stop), (e_start, e_stop) in zip(bounds, extent)
+        ]
+    shape = tuple(max(stop - start, 0) for start, stop in bounds)
+    if 0 in shape:
+        # The block is wholly outside of the dataset:
+        dtype = dtype or manager.get_dtype(col, exp, chan) or "uint8"
+        return np.zeros(block_size, dtype=dtype)
+    try:
+        data = manager.getdata(col, exp, chan, res, *bounds)
+    except IndexError:
+        # Out of bounds upstream; the window alone may still be readable.
+        return None
+    if data is None or tuple(data.shape) != shape:
+        return None
+    if shape == tuple(block_size):
+        return data
+    block = np.zeros(block_size, dtype=data.dtype)
+    window = tuple(slice(start - o, stop - o) for (start, stop), o in zip(bounds, f))
+    block[window] = data
+    return block
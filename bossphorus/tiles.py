@@ -0,0 +1,343 @@
+"""
+Copyright 2018 The Johns Hopkins University Applied Physics Laboratory.
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+from collections import OrderedDict
+from typing import List, Optional, Tuple
+import io
+import struct
+import threading
+import time
+import zlib
+
+import numpy as np
+
+try:
+    from PIL import Image
+except ImportError:  # pragma: no cover
+    # PNG is encoded without Pillow, but JPEG needs it.
+    Image = None
+
+# The axes (of x, y, z) along the columns and rows of an image, and the axis
+# that it is a slice of, for each orientation:
+ORIENTATIONS = {"xy": (0, 1, 2), "xz": (0, 2, 1), "yz": (1, 2, 0)}
+
+MIMETYPES = {"png": "image/png", "jpeg": "image/jpeg"}
+
+
+def plane_bounds(orientation: str, args: List[str]) -> List[Tuple[int, int]]:
+    """
+    Get the bounds of an image from the x, y and z arguments of its URL.
+
+    The two axes of the image are given as "start:stop" ranges, and the
+    third as a single index.
+
+    Arguments:
+        orientation (str): "xy", "xz" or "yz"
+        args: The x, y and z arguments
+
+    Returns:
+        List[Tuple[int, int]]: The (start, stop) bounds of x, y and z
+
+    """
+    if orientation not in ORIENTATIONS:
+        raise ValueError(f"Orientation must be one of {', '.join(ORIENTATIONS)}.")
+    sliced = ORIENTATIONS[orientation][2]
+    bounds = []
+    for axis, arg in enumerate(args):
+        if axis == sliced:
+            index = int(arg)
+            bounds.append((index, index + 1))
+        else:
+            start, stop = (int(i) for i in arg.split(":"))
+            bounds.append((start, stop))
+    if any(stop <= start for start, stop in bounds):
+        raise ValueError("Image ranges must not be empty.")
+    return bounds
+
+
+def tile_bounds(
+    orientation: str, tile_size: int, indices: List[int]
+) -> List[Tuple[int, int]]:
+    """
+    Get the bounds of a tile from its x, y and z indices.
+
+    The two axes of the tile are indexed in units of `tile_size`, and the
+    third is the index of the slice.
+
+    Arguments:
+        orientation (str): "xy", "xz" or "yz"
+        tile_size (int): The width and height of the tile
+        indices: The x, y and z indices
+
+    Returns:
+        List[Tuple[int, int]]: The (start, stop) bounds of x, y and z
+
+    """
+    if orientation not in ORIENTATIONS:
+        raise ValueError(f"Orientation must be one of {', '.join(ORIENTATIONS)}.")
+    if tile_size <= 0:
+        raise ValueError("Tile size must be positive.")
+    sliced = ORIENTATIONS[orientation][2]
+    return [
+        (i, i + 1) if axis == sliced else (i * tile_size, (i + 1) * tile_size)
+        for axis, i in enumerate(indices)
+    ]
+
+
+def to_plane(data: np.ndarray, orientation: str) -> np.ndarray:
+    """
+    Turn an XYZ volume one voxel thick into a (rows, columns) image.
+    """
+    # Once the sliced axis is gone, the columns come before the rows:
+    return np.take(data, 0, axis=ORIENTATIONS[orientation][2]).T
+
+
+def _png_chunk(kind: bytes, body: bytes) -> bytes:
+    return (
+        struct.pack(">I", len(body))
+        + kind
+        + body
+        + struct.pack(">I", zlib.crc32(kind + body))
+    )
+
+
+def encode_png(plane: np.ndarray, level: int = 6) -> bytes:
+    """
+    Encode an image as a greyscale PNG.
+
+    uint8 images are 8-bit, and uint16 images are 16-bit.
+
+    Arguments:
+        plane: A (rows, columns) image
+        level (int: 6): The zlib compression level
+
+    Returns:
+        bytes
+
+    """
+    if plane.dtype not in (np.uint8, np.uint16):
+        raise ValueError(f"Can't encode {plane.dtype} data as an image.")
+    rows, columns = plane.shape
+    # PNG samples are big-endian, and each row starts with a filter type
+    # (0 is none):
+    samples = plane.astype(plane.dtype.newbyteorder(">"), copy=False)
+    scanlines = np.zeros((rows, 1 + columns * plane.itemsize), dtype=np.uint8)
+    scanlines[:, 1:] = np.ascontiguousarray(samples).view(np.uint8).reshape(rows, -1)
+    header = struct.pack(">IIBBBBB", columns, rows, 8 * plane.itemsize, 0, 0, 0, 0)
+    return b"".join(
+        [
+            b"\x89PNG\r\n\x1a\n",
+            _png_chunk(b"IHDR", header),
+            _png_chunk(b"IDAT", zlib.compress(scanlines.tobytes(), level)),
+            _png_chunk(b"IEND", b""),
+        ]
+    )
+
+
+def encode_jpeg(plane: np.ndarray, quality: int = 90) -> bytes:
+    """
+    Encode an image as a greyscale JPEG. This needs Pillow.
+
+    JPEG holds 8 bits per sample, so uint16 images keep their top 8 bits.
+
+    Arguments:
+        plane: A (rows, columns) image
+        quality (int: 90): The JPEG quality, from 1 to 95
+
+    Returns:
+        bytes
+
+    """
+    if Image is None:
+        raise RuntimeError("JPEG images need Pillow (`pip install pillow`).")
+    if plane.dtype == np.uint16:
+        plane = (plane >> 8).astype(np.uint8)
+    elif plane.dtype != np.uint8:
+        raise ValueError(f"Can't encode {plane.dtype} data as an image.")
+    out = io.BytesIO()
+    Image.fromarray(np.ascontiguousarray(plane), mode="L").save(
+        out, format="JPEG", quality=quality
+    )
+    return out.getvalue()
+
+
+def encode_image(plane: np.ndarray, fmt: str) -> bytes:
+    """
+    Encode an image as "png" or "jpeg".
+    """
+    if fmt == "jpeg":
+        return encode_jpeg(plane)
+    return encode_png(plane)
+
+
+class TileCache:
+    """
+    A bounded in-memory cache of encoded tiles.
+
+    Tiles are keyed by (col, exp, chan, res, orientation, tile size, x, y, z,
+    format), and the least recently used tiles are evicted once the cache
+    holds more than `max_bytes`. A write to a region drops every tile of the
+    same resolution that overlaps it, along with every tile of the channel
+    at a lower resolution, since those are built from the data beneath.
+
+    Each process keeps a cache of its own, as MemoryCacheStorageManager does,
+    and only sees the writes made through it. When other processes write to
+    the same data, pass `ttl` to bound how long a tile may be served out of
+    date.
+    """
+
+    def __init__(
+        self, max_bytes: int = 256 * 2 ** 20, ttl: Optional[float] = None
+    ) -> None:
+        """
+        Create a new TileCache.
+
+        Arguments:
+            max_bytes (int: 256 MiB): The most encoded tile data to hold. 0
+                caches nothing.
+            ttl (float: None): How long, in seconds, a tile is kept. By
+                default, tiles are kept until a write or eviction drops them.
+        """
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self._tiles = OrderedDict()
+        # The keys of the tiles of each channel, so that writes needn't scan
+        # the whole cache:
+        self._channels = {}
+        # Bumped by every write to a channel, so that a tile rendered while a
+        # write was landing is not cached:
+        self._generations = {}
+        self._nbytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def generation(self, col: str, exp: str, chan: str) -> int:
+        """
+        Get the number of writes to a channel so far.
+
+        Pass it to `put` with a tile that is rendered afterwards.
+        """
+        with self._lock:
+            return self._generations.get((col, exp, chan), 0)
+
+    def get(self, key: Tuple) -> Optional[bytes]:
+        """
+        Get a cached tile, or None if it isn't cached.
+        """
+        with self._lock:
+            entry = self._tiles.get(key)
+            if entry is not None and entry[2] is not None:
+                if time.monotonic() >= entry[2]:
+                    self._drop(key)
+                    entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self._tiles.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(
+        self, key: Tuple, bounds: List[Tuple[int, int]], tile: bytes, generation: int
+    ):
+        """
+        Cache a tile, unless its channel has been written since `generation`.
+
+        Arguments:
+            key: The key of the tile. It starts with col, exp, chan and res.
+            bounds: The (start, stop) bounds of x, y and z of the tile
+            tile: The encoded tile
+            generation: The channel's `generation` from before the tile was
+                read
+
+        """
+        if len(tile) > self.max_bytes:
+            return
+        channel = tuple(key[:3])
+        with self._lock:
+            if self._generations.get(channel, 0) != generation:
+                return
+            if key in self._tiles:
+                self._drop(key)
+            expires = None if self.ttl is None else time.monotonic() + self.ttl
+            self._tiles[key] = (tile, bounds, expires)
+            self._channels.setdefault(channel, set()).add(key)
+            self._nbytes += len(tile)
+            while self._nbytes > self.max_bytes:
+                self._drop(next(iter(self._tiles)))
+
+    def _drop(self, key: Tuple):
+        """
+        Must be called with the lock held.
+        """
+        tile = self._tiles.pop(key)[0]
+        self._nbytes -= len(tile)
+        channel = tuple(key[:3])
+        keys = self._channels[channel]
+        keys.discard(key)
+        if not keys:
+            del self._channels[channel]
+
+    def invalidate(
+        self,
+        col: str,
+        exp: str,
+        chan: str,
+        res: int,
+        xs: Tuple[int, int],
+        ys: Tuple[int, int],
+        zs: Tuple[int, int],
+    ):
+        """
+        Drop the tiles that a write to a region makes out of date.
+
+        Arguments:
+            bossURI
+
+        """
+        region = [xs, ys, zs]
+        channel = (col, exp, chan)
+        with self._lock:
+            self._generations[channel] = self._generations.get(channel, 0) + 1
+            for key in list(self._channels.get(channel, ())):
+                tile_res = key[3]
+                if tile_res > int(res):
+                    self._drop(key)
+                elif tile_res == int(res) and all(
+                    start < r_stop and r_start < stop
+                    for (start, stop), (r_start, r_stop) in zip(
+                        self._tiles[key][1], region
+                    )
+                ):
+                    self._drop(key)
+
+    def cache_info(self):
+        """
+        Get the hit and miss counts and the size of the cache.
+
+        Returns:
+            dict
+
+        """
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "tiles": len(self._tiles),
+                "bytes": self._nbytes,
+                "max_bytes": self.max_bytes,
+                "ttl": self.ttl,
+            }
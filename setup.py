@@ -26,6 +26,12 @@ REQUIRED = ["intern", "flask", "h5py", "numpy", "blosc"]
 # What packages are suggested for doing development?
 DEVELOPING_REQS = ["pytest", "pylint"]
 
+# What packages are needed to run the production server?
+SERVER_REQS = ["gunicorn"]
+
+# What packages are needed to serve JPEG images and tiles?
+IMAGE_REQS = ["pillow"]
+
 here = os.path.abspath(os.path.dirname(__file__))
 
 with io.open(os.path.join(here, "README.md"), encoding="utf-8") as f:
@@ -85,8 +91,13 @@ setup(
     url=URL,
     packages=find_packages(exclude=("tests",)),
     scripts=[],
+    entry_points={"console_scripts": ["bossphorus=bossphorus.__main__:main"]},
     install_requires=REQUIRED,
-    extras_require={"dev": DEVELOPING_REQS},
+    extras_require={
+        "dev": DEVELOPING_REQS,
+        "server": SERVER_REQS,
+        "images": IMAGE_REQS,
+    },
     include_package_data=True,
     license="Apache 2.0",
     classifiers=[